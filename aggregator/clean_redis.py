@@ -1,12 +1,147 @@
-from redis import Redis 
+import argparse
+import time
+from datetime import date, datetime, timedelta
+from redis import Redis, WatchError
+import rollups
+import sessions_index
+from main import Aggregator, DATA_VERSION_KEY, OPEN_KEY, STATE_KEY
+from rebuild import LIVE_PATTERNS, scan_keys
 
+# Deletes closed sessions that ended in a time range, or everything the aggregator wrote.
+#
+# Sessions are deleted in chunks, each in a MULTI watching the documents and agg:day, which also
+# takes the sessions out of the sessions set and the index and subtracts them from today's counters,
+# so the counters always add up to the sessions left. The hourly and daily rollups are the long-term
+# record that outlives the session documents and are kept, unless --with-rollups asks for the
+# sessions to be subtracted from them too. The sessions the
+# aggregator holds in memory (open ones, and the recent one per classification) are never
+# deleted, so this is safe while it runs. --all is not: stop the aggregators first, they would
+# write their sessions back.
 
-client = Redis(decode_responses=True)
 
-for key in client.scan_iter("sessions:*"):
-    client.delete(key)
-    print("Deleting: ", key)
+def day_start(day):
+    return datetime.combine(day, datetime.min.time()).timestamp()
 
-client.delete("sessions")
 
-print("Done :)")
\ No newline at end of file
+def held_sessions(client):
+    """The ids of the sessions an aggregator may still change."""
+    held = set(client.smembers(OPEN_KEY))
+    for key in client.scan_iter(f"{STATE_KEY}*"):
+        held.update(value for field, value in client.hgetall(key).items() if field.startswith("recent:"))
+    return held
+
+
+def ending_between(client, start, end, chunk=500):
+    """The ids of the sessions that ended in [start, end), from the index or else from the documents."""
+    if sessions_index.is_indexed(client):
+        return sessions_index.ending_between(client, start, end)
+    ids = sorted(client.smembers("sessions"))
+    selected = []
+    for i in range(0, len(ids), chunk):
+        docs = client.json().mget([f"sessions:{_id}" for _id in ids[i:i + chunk]], ".")
+        selected += [_id for _id, doc in zip(ids[i:i + chunk], docs) if doc and doc['end'] and start <= doc['end'] < end]
+    return selected
+
+
+def delete_sessions(client, ids, start, end, chunk=500, with_rollups=False):
+    """
+    Deletes the sessions among ids that are closed, ended in [start, end) and aren't held by an aggregator.
+
+    Their time is subtracted from the rollups too only with with_rollups, the rollups keep it otherwise.
+
+    Returns:
+        int: The number of sessions deleted.
+    """
+    agg = Aggregator(retain=None, client=client)
+    held = held_sessions(client)
+    ids = [_id for _id in ids if _id not in held]
+    deleted = 0
+    for i in range(0, len(ids), chunk):
+        chunk_ids = ids[i:i + chunk]
+        keys = [f"sessions:{_id}" for _id in chunk_ids]
+        while True:
+            with client.pipeline() as pipe:
+                try:
+                    pipe.watch("agg:day", *keys)
+                    day = pipe.get("agg:day")
+                    agg.day = date.fromisoformat(day) if day else None
+                    docs = pipe.json().mget(keys, ".")
+                    gone = [(_id, doc) for _id, doc in zip(chunk_ids, docs) if doc and doc['end'] and start <= doc['end'] < end]
+                    deltas, buckets = {}, {}
+                    for _id, doc in gone:
+                        # Today's counters only exist for the day in agg:day
+                        if agg.day:
+                            for key, value in agg.contribution(doc).items():
+                                deltas[key] = deltas.get(key, 0) - value
+                        if with_rollups:
+                            for key, value in rollups.allocate(doc).items():
+                                buckets[key] = buckets.get(key, 0) - value
+                    pipe.multi()
+                    if gone:
+                        gone_ids = [_id for _id, _ in gone]
+                        pipe.unlink(*[f"sessions:{_id}" for _id in gone_ids])
+                        pipe.srem("sessions", *gone_ids)
+                        sessions_index.unindex_sessions(pipe, gone_ids)
+                        for key, delta in deltas.items():
+                            if delta:
+                                pipe.incrby(key, delta)
+                        for (key, field), delta in buckets.items():
+                            if delta:
+                                pipe.hincrby(key, field, delta)
+                        pipe.incr(DATA_VERSION_KEY)
+                    pipe.execute()
+                    deleted += len(gone)
+                    break
+                except WatchError:
+                    # The aggregator wrote one of them, or rolled the day over: read them again
+                    continue
+        print(f"Deleted {deleted} sessions ({min(i + chunk, len(ids))}/{len(ids)} checked)")
+    return deleted
+
+
+def all_keys(client):
+    """Every key the aggregator wrote, except the index version: an index of no sessions is complete."""
+    return [key for key in scan_keys(client, LIVE_PATTERNS) if key != sessions_index.VERSION_KEY]
+
+
+def delete_all(client, chunk=1000):
+    """Unlinks every key the aggregator wrote, so it starts over from the beginning of the stream."""
+    keys = all_keys(client)
+    pipe = client.pipeline(transaction=False)
+    for i in range(0, len(keys), chunk):
+        pipe.unlink(*keys[i:i + chunk])
+    pipe.incr(DATA_VERSION_KEY)
+    pipe.execute()
+    return len(keys)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Deletes aggregated sessions, keeping the counters and rollups consistent.")
+    selection = parser.add_mutually_exclusive_group(required=True)
+    selection.add_argument("--older-than", type=float, metavar="DAYS", help="delete the sessions that ended more than DAYS days ago")
+    selection.add_argument("--before", type=date.fromisoformat, metavar="YYYY-MM-DD", help="delete the sessions that ended before this day")
+    selection.add_argument("--day", type=date.fromisoformat, metavar="YYYY-MM-DD", help="delete the sessions that ended on this day")
+    selection.add_argument("--all", action="store_true", help="delete every session, counter, rollup and the aggregator state; stop the aggregators first")
+    parser.add_argument("--with-rollups", action="store_true", help="subtract the deleted sessions from the hourly and daily rollups too")
+    parser.add_argument("--dry-run", action="store_true", help="only count what would be deleted")
+    args = parser.parse_args()
+
+    client = Redis(decode_responses=True)
+    if args.all:
+        if args.dry_run:
+            print(f"Would delete {len(all_keys(client))} keys")
+        else:
+            print(f"Deleted {delete_all(client)} keys, the aggregator will start over from the beginning of the stream")
+    else:
+        if args.older_than is not None:
+            start, end = 0, time.time() - args.older_than * 86400
+        elif args.before:
+            start, end = 0, day_start(args.before)
+        else:
+            start, end = day_start(args.day), day_start(args.day + timedelta(days=1))
+        ids = ending_between(client, start, end)
+        if args.dry_run:
+            held = held_sessions(client)
+            print(f"Would delete {len([_id for _id in ids if _id not in held])} sessions ({len(ids)} match, the others are still held by the aggregator)")
+        else:
+            print(f"Done, deleted {delete_sessions(client, ids, start, end, with_rollups=args.with_rollups)} sessions")
@@ -0,0 +1,83 @@
+import json
+
+# Reads the activity stream entries written by the stalker, see classification/event_encoding.py.
+# Version 1 entries hold the event as JSON in a "data" field; version 2 entries hold it as native
+# fields, with repeated strings interned in the events:strings hash.
+STRINGS_KEY = "events:strings"
+
+
+def event_id(fields):
+    """The id of the event in the fields of one stream entry, without decoding the rest of it."""
+    if not fields:
+        return None
+    if "data" in fields:
+        try:
+            return json.loads(fields["data"]).get("id")
+        except (ValueError, AttributeError):
+            # Left to decode() to report
+            return None
+    return fields.get("i")
+
+
+class EventDecoder(object):
+    def __init__(self, client):
+        self.client = client
+        self.strings = {}  # id -> string, interned strings never change
+
+    def resolve(self, entries):
+        """Loads the interned strings a batch of version 2 entries refers to that aren't known yet."""
+        missing = list({
+            fields[name] for (_, fields) in entries if fields and fields.get("v") == "2"
+            for name in ("c", "a", "k", "d", "r") if fields.get(name) and fields[name] not in self.strings
+        })
+        if missing:
+            for _id, value in zip(missing, self.client.hmget(STRINGS_KEY, missing)):
+                if value is not None:
+                    self.strings[_id] = value
+
+    def string(self, _id):
+        return self.strings.get(_id) if _id else None
+
+    def decode_fields(self, fields):
+        """Turns the fields of one stream entry into the event dict, in the same shape for both versions."""
+        if "data" in fields:
+            return json.loads(fields["data"])
+        if fields.get("v") != "2":
+            raise ValueError(f"unknown event format {fields.get('v')}")
+        directory = self.string(fields["d"])
+        event = {
+            "id": fields["i"],
+            "timestamp": float(fields["t"]),
+            "state": fields["s"] == "1",
+            "classification": self.string(fields["c"]),
+            "app_name": self.string(fields["a"]),
+            "win_title": fields["w"],
+            "icon": self.string(fields["k"]),
+            "screenshot": directory + fields["p"] if directory is not None else None,
+            "tier": self.string(fields["r"]),
+            "deduplicated": fields["u"] == "1",
+            "confidence": float(fields["q"]) if fields["q"] else None,
+        }
+        if fields["s"] == "2":
+            # A closed window classified after the fact, sent with state False
+            event["reclassify"] = True
+        return event
+
+    def decode(self, entries):
+        """
+        Decodes (stream id, fields) entries read from the stream.
+
+        Returns (stream id, event) pairs, with None for entries that were deleted
+        from the stream or can't be decoded.
+        """
+        self.resolve(entries)
+        events = []
+        for (_id, fields) in entries:
+            event = None
+            if fields:
+                try:
+                    event = self.decode_fields(fields)
+                except Exception as e:
+                    print(f"Invalid entry {_id}: {e}")
+            events.append((_id, event))
+        return events
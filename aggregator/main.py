@@ -1,39 +1,165 @@
-import json
-from redis import Redis 
+import argparse
+import copy
+import socket
+import zlib
+from redis import Redis, ResponseError, WatchError
 import time 
 from datetime import datetime, timedelta 
+import rollups
+import sessions_index
+from events import EventDecoder, event_id
+from retention import Retention
 
 
 class Aggregator(object):
-    def __init__(self):
-        self.client = Redis(decode_responses=True)
+    def __init__(self, batch_size=1000, count=100, block=5000, retain=None, archive_dir=None, flush_interval=1.0, client=None):
+        self.client = client or Redis(decode_responses=True)
+        self.decoder = EventDecoder(self.client)
+        # Trims processed entries older than retain seconds from the stream, None to never trim
+        self.retention = Retention(self.client, retain, archive_dir) if retain is not None else None
+        # Maximum number of stream entries read and written per round trip
+        self.batch_size = batch_size
+        # Number of entries asked for per read while keeping up with the stream
+        self.count = min(count, batch_size)
+        # How long an idle read waits for new entries, in milliseconds
+        self.block = block
+        # The day the agg:total:* / agg:app:* counters currently cover
+        self.day = None
+        # Write-behind session state: open sessions, and the most recent closed one per
+        # classification, live in memory and are written to Redis at most every flush_interval
+        # seconds while catching up, and whenever the stream is drained
+        self.flush_interval = flush_interval
+        self.last_flush = time.time()
+        self.sessions = {}  # session id -> SessionRecord
+        self.aliases = {}  # event id -> id of the session its window was merged into
+        self.recent = {}  # classification -> id of the most recently closed session
+        self.dirty = set()  # ids of the sessions changed since the last flush
+        self.state_changes = {}  # agg:state field -> new value, None to delete it
+        self.position = None  # stream id of the last entry processed, for agg:last_id
+        self.acks = []  # stream ids to acknowledge, in consumer group mode
+        self.group = None
+        self.lease = None  # (key, consumer) of the partition lease held in consumer group mode
     
     def today(self, timestamp: str):
         if not timestamp:
             return False
-        return datetime.fromtimestamp(timestamp).date() == datetime.now().date()
+        return datetime.fromtimestamp(timestamp).date() == (self.day or datetime.now().date())
     
-    def process_event(self, event):
-        if not event.get("id"):
-            print("Invalid event: ", event)
+    def contribution(self, session):
+        """What a session adds to today's counters, keyed by counter name."""
+        totals = {}
+        if session and self.today(session['end']):
+            totals[f"agg:total:{session['classification']}"] = int(session['duration'])
+            for app in session['apps']:
+                key = f"agg:app:{app['name']}"
+                totals[key] = totals.get(key, 0) + int(app['duration'])
+        return totals
+    
+    def counter_keys(self):
+        return counter_keys(self.client)
+    
+    def totals_from_sessions(self):
+        """Recompute today's counters from the sessions that ended today, or every session before the index is built."""
+        if sessions_index.is_indexed(self.client):
+            day = self.day or datetime.now().date()
+            start = datetime.combine(day, datetime.min.time()).timestamp()
+            end = datetime.combine(day + timedelta(days=1), datetime.min.time()).timestamp()
+            ids = sessions_index.ending_between(self.client, start, end)
+        else:
+            ids = list(self.client.smembers("sessions"))
+        totals = {}
+        for i in range(0, len(ids), self.batch_size):
+            keys = [f"sessions:{_id}" for _id in ids[i:i + self.batch_size]]
+            for session in self.client.json().mget(keys, "."):
+                for key, value in self.contribution(session).items():
+                    totals[key] = totals.get(key, 0) + value
+        return totals
+    
+    def rollover(self):
+        """
+        Moves the counters to the current day.
+
+        A process that was running across midnight resets them to zero, since only
+        sessions ending today are counted. A process that just started rebuilds them
+        once from the sessions if they belong to another day. Either way the swap is
+        a single MULTI guarded by agg:day, so concurrent workers only do it once and
+        the dashboard never sees half-built counters.
+        """
+        today = datetime.now().date()
+        if self.day == today:
             return
-        self.client.sadd("sessions", event['id'])
+        rebuild = self.day is None
+        self.day = today
+        if rebuild and not self.client.exists(COUNTERS_KEY):
+            # Counters written before agg:counters existed are registered once
+            keys = counter_keys(self.client)
+            if keys:
+                self.client.sadd(COUNTERS_KEY, *keys)
         
+        def swap(pipe):
+            if pipe.get("agg:day") == today.isoformat():
+                return
+            print(f"{'Rebuilding' if rebuild else 'Resetting'} totals for ", today)
+            totals = self.totals_from_sessions() if rebuild else {}
+            keys = self.counter_keys()
+            pipe.multi()
+            pipe.delete(COUNTERS_KEY, *keys)
+            if totals:
+                pipe.mset(totals)
+                pipe.sadd(COUNTERS_KEY, *totals)
+            pipe.set("agg:day", today.isoformat())
+            pipe.incr(DATA_VERSION_KEY)
         
+        self.client.transaction(swap, "agg:day")
+    
+    def commit(self, queue):
+        """
+        Runs queue(pipe) in a MULTI, but only while agg:day still matches the day
+        the queued counter deltas were computed for, and while this worker still
+        holds its partition's lease in consumer group mode.
+
+        Returns False if another worker rolled the counters over first, raises
+        LeaseLost if another consumer took the partition over.
+        """
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch("agg:day", *([self.lease[0]] if self.lease else []))
+                if self.lease and pipe.get(self.lease[0]) != self.lease[1]:
+                    raise LeaseLost(self.lease[0])
+                if pipe.get("agg:day") != self.day.isoformat():
+                    return False
+                pipe.multi()
+                queue(pipe)
+                pipe.execute()
+                return True
+            except WatchError:
+                return False
+    
+    def apply_event(self, existing, last_session, event):
+        """
+        Applies one event to its session document in memory.
+
+        Each window is one app entry, updated in place while it keeps focus and
+        closed when another window opens in the session or the session closes.
+
+        Returns the session id and the updated document, or (None, None) when
+        the event closes a session that was never opened.
+        """
+        existing = copy.deepcopy(existing or {})
+        if event.get('reclassify'):
+            # A window closed before the stalker's model classified it: only a pending session changes
+            if existing.get('classification') != PENDING_CLASSIFICATION:
+                return None, None
+            existing['classification'] = event['classification']
+            return existing.get('id') or event['id'], existing
         
-        existing = self.client.json().get(f"sessions:{event['id']}") or {}
+        if not existing and (last_session or {}).get('classification') == event['classification']:
+            existing = copy.deepcopy(last_session)
         
-        if not existing:
-            recent_id = self.client.get("agg:last_id")
-            last_session = self.client.json().get(f"sessions:{recent_id}") or {}
-            
-            if last_session.get('classification') == event['classification']:
-                existing = last_session
-        
-        _id = (existing or {}).get('id') or event['id']
+        _id = existing.get('id') or event['id']
         if event['state']:
             # Open a new session 
-            new_doc = {
+            doc = {
                 "start": existing.get("start") or event['timestamp'],
                 "end": None,
                 "duration": 0,
@@ -41,89 +167,696 @@ class Aggregator(object):
                 "apps": existing.get("apps") or [],
                 "id": _id
             }
-            self.client.json().set(f"sessions:{_id}", "$", new_doc)
-            
-            self.client.json().arrappend(f"sessions:{_id}", "$.apps", {
-                "name": event['app_name'],
-                "title": event['win_title'],
-                "start": event['timestamp'],
-                "end": None,
-                "duration": 0,
-                "screenshot": event['screenshot'],
-                "icon": event['icon'],
-            })
+            last = doc['apps'][-1] if doc['apps'] else None
+            if last and last['end'] is None and (last['name'], last['title']) == (event['app_name'], event['win_title']):
+                # Same window as before: an update, keep the entry and refresh its screenshot
+                last['screenshot'] = event['screenshot'] or last['screenshot']
+                last['icon'] = event['icon'] or last['icon']
+            else:
+                close_apps(doc['apps'], event['timestamp'])
+                doc['apps'].append({
+                    "name": event['app_name'],
+                    "title": event['win_title'],
+                    "start": event['timestamp'],
+                    "end": None,
+                    "duration": 0,
+                    "screenshot": event['screenshot'],
+                    "icon": event['icon'],
+                })
         else:
-            
             # safety check
             if not existing:
-                return
+                return None, None
             # Close the session 
-            self.client.json().set(f"sessions:{_id}", "$.end", event['timestamp'])
-            # close all the apps 
-            for app in existing['apps']:
-                if not app['end']:
-                    app['end'] = event['timestamp']
-                    app['duration'] = int(app['end'] - app['start'])
-                    self.client.json().arrappend(f"sessions:{_id}", "$.apps", app)
+            doc = existing
+            doc['end'] = event['timestamp']
+            close_apps(doc['apps'], event['timestamp'])
         
+        # update the duration of the session and of its open app
+        doc['duration'] = int(event['timestamp'] - doc['start'])
+        for app in doc['apps']:
+            if app['end'] is None:
+                app['duration'] = int(max(0, event['timestamp'] - app['start']))
+        doc['apps'] = compact_apps(doc['apps'])
+        return _id, doc
+    
+    @property
+    def state_key(self):
+        """The hash holding the recent sessions and aliases, one per consumer group."""
+        return f"{STATE_KEY}:{self.group}" if self.group else STATE_KEY
+    
+    def recover(self, partition=0, partitions=1):
+        """
+        Loads the open sessions of this partition, the recent sessions and the aliases
+        from Redis, as of the last flush.
+
+        agg:last_id (or the pending entries of the group) was written in the same
+        MULTI, so reading the stream from there replays exactly what was lost.
+        """
+        sessions_index.init(self.client)
+        self.sessions, self.aliases, self.recent = {}, {}, {}
+        self.dirty, self.state_changes, self.acks = set(), {}, []
+        state = self.client.hgetall(self.state_key)
+        for field, value in state.items():
+            kind, _, name = field.partition(":")
+            if kind == "recent":
+                self.recent[name] = value
+            elif kind == "alias":
+                self.aliases[name] = value
         
-        existing = self.client.json().get(f"sessions:{_id}")
-        print("event: ", event, "existing: ", existing)
-        # update the duration of the session
-        self.client.json().set(f"sessions:{_id}", "$.duration", int(event['timestamp'] - existing['start']))
-        print(f"Updating duration of session {_id} to {event['timestamp'] - existing['start']} from {existing['duration']}")
-        # update the duration of the apps
-        apps = self.client.json().get(f"sessions:{_id}", "$.apps")
-        for pos, app in enumerate(apps[0] if apps else []):
-            duration = max(0, (app['end'] or event['timestamp']) - app['start'])
-            print(f"Updating duration of {app['name']} to {duration} from {app['duration']}")
-            self.client.json().set(f"sessions:{_id}", f"$.apps[{pos}].duration", int(duration))
+        # Sessions stored before the open ones were tracked have to be scanned once
+        ids = self.client.smembers(OPEN_KEY if state else "sessions")
+        ids = [_id for _id in ids if partition_of(_id, partitions) == partition]
+        ids = list(dict.fromkeys(ids + list(self.recent.values())))
+        for i in range(0, len(ids), self.batch_size):
+            chunk = ids[i:i + self.batch_size]
+            for _id, doc in zip(chunk, self.client.json().mget([f"sessions:{_id}" for _id in chunk], ".")):
+                if doc and (doc['end'] is None or _id in self.recent.values()):
+                    self.sessions[_id] = SessionRecord(doc, doc)
+        print(f"Recovered {len(self.sessions)} sessions")
+    
+    def set_state(self, kind, name, value):
+        field = f"{kind}:{name}"
+        self.state_changes[field] = value
+    
+    def session_of(self, event):
+        """The id of the session an event applies to, once windows merged into another session are resolved."""
+        if event.get('reclassify'):
+            # Pending windows are never merged, a reclassification only ever targets its own session
+            return event['id']
+        return self.aliases.get(event['id'], event['id'])
+    
+    def process_batch(self, entries, ack=()):
+        """
+        Applies a batch of (stream id, event) entries to the sessions held in memory.
+
+        Nothing is read from Redis, except for closing events of sessions that aren't
+        in memory, which are loaded in one round trip. The changes, and the position
+        in the stream (agg:last_id, or the acknowledgements of the stream ids in ack
+        in consumer group mode), are written together by flush().
+        """
+        events = [event for (_, event) in entries if event and event.get("id")]
+        for (_, event) in entries:
+            if not event or not event.get("id"):
+                print("Invalid event: ", event)
+        
+        missing = list(dict.fromkeys(
+            event['id'] for event in events
+            if not event['state'] and self.session_of(event) not in self.sessions
+        ))
+        if missing:
+            found = self.client.json().mget([f"sessions:{_id}" for _id in missing], ".")
+            for _id, doc in zip(missing, found):
+                if doc:
+                    self.sessions[_id] = SessionRecord(doc, doc)
+        
+        for event in events:
+            record = self.sessions.get(self.session_of(event))
+            last_session = None
+            if record is None and event['state']:
+                # A window right after a session of the same classification continues it, unless it's still
+                # pending: each pending window is reclassified on its own
+                recent = self.sessions.get(self.recent.get(event['classification']))
+                if recent and recent.doc['end'] == event['timestamp'] and event['classification'] != PENDING_CLASSIFICATION:
+                    last_session = recent.doc
+            _id, doc = self.apply_event(record.doc if record else None, last_session, event)
+            if doc is None:
+                continue
+            print(f"Updating session {_id}: duration {doc['duration']}")
             
-    def run(self):
-        n = 0
+            if _id != event['id'] and self.aliases.get(event['id']) != _id:
+                self.aliases[event['id']] = _id
+                self.set_state("alias", event['id'], _id)
+            if _id in self.sessions:
+                self.sessions[_id].doc = doc
+            else:
+                self.sessions[_id] = SessionRecord(doc, None)
+            if doc['end'] is not None and not event.get('reclassify') and self.recent.get(doc['classification']) != _id:
+                self.recent[doc['classification']] = _id
+                self.set_state("recent", doc['classification'], _id)
+            self.dirty.add(_id)
+        
+        if entries and entries[-1][0] is not None:
+            self.position = entries[-1][0]
+        self.acks.extend(ack)
+    
+    def flush_due(self):
+        return time.time() - self.last_flush >= self.flush_interval or len(self.dirty) >= self.batch_size
+    
+    def flush(self):
+        """
+        Writes the changed sessions, the counter and rollup deltas, the state and the
+        position in the stream in a single MULTI, then forgets the closed sessions
+        that are no longer needed.
+
+        The deltas are computed from what was last written for each session, so
+        they are simply recomputed if the day changes under us.
+        """
+        self.last_flush = time.time()
+        if not self.dirty and not self.state_changes and self.position is None and not self.acks:
+            return
+        
         while True:
-            last_id = self.client.get("agg:last_id") or 0
+            self.rollover()
+            deltas = {}
+            counters = set()
+            buckets = {}
+            for _id in self.dirty:
+                record = self.sessions[_id]
+                before = self.contribution(record.stored)
+                after = self.contribution(record.doc)
+                for key in before.keys() | after.keys():
+                    deltas[key] = deltas.get(key, 0) + after.get(key, 0) - before.get(key, 0)
+                counters.update(after)
+                
+                before = rollups.allocate(record.stored)
+                after = rollups.allocate(record.doc)
+                for key in before.keys() | after.keys():
+                    buckets[key] = buckets.get(key, 0) + after.get(key, 0) - before.get(key, 0)
             
-            itm = self.client.xread(streams={"activity": last_id})
+            def queue(pipe):
+                if self.dirty:
+                    pipe.sadd("sessions", *self.dirty)
+                    pipe.incr(DATA_VERSION_KEY)
+                for _id in self.dirty:
+                    record = self.sessions[_id]
+                    write_session(pipe, f"sessions:{_id}", record.stored, record.doc)
+                    sessions_index.index_session(pipe, _id, record.doc)
+                    if record.doc['end'] is None:
+                        pipe.sadd(OPEN_KEY, _id)
+                    elif record.stored is None or record.stored['end'] is None:
+                        pipe.srem(OPEN_KEY, _id)
+                for key, delta in deltas.items():
+                    if delta or key in counters:
+                        pipe.incrby(key, delta)
+                if counters:
+                    pipe.sadd(COUNTERS_KEY, *counters)
+                for (key, field), delta in buckets.items():
+                    if delta:
+                        pipe.hincrby(key, field, delta)
+                stale = [field for field, value in self.state_changes.items() if value is None]
+                if stale:
+                    pipe.hdel(self.state_key, *stale)
+                # Always written, so the hash's existence says the open sessions are tracked
+                pipe.hset(self.state_key, mapping=dict(
+                    {field: value for field, value in self.state_changes.items() if value is not None}, version=1
+                ))
+                if self.group:
+                    if self.acks:
+                        pipe.xack("activity", self.group, *self.acks)
+                elif self.position is not None:
+                    pipe.set("agg:last_id", self.position)
             
-            if itm and (d := itm[0]):
-                print("itm: ", d)
-                _id = last_id
-                for (_id, event) in d[1]:
-                    self.process_event(
-                        json.loads(event['data'])
-                    )
-                    self.client.set("agg:last_id", _id)
+            if self.commit(queue):
+                break
+            # The day changed under us: recompute the deltas against the new one
+        
+        for _id in self.dirty:
+            self.sessions[_id].stored = self.sessions[_id].doc
+        self.dirty, self.state_changes, self.position, self.acks = set(), {}, None, []
+        
+        # Closed sessions are only kept while they may still be continued
+        keep = set(self.recent.values())
+        closed = {_id for _id, record in self.sessions.items() if record.doc['end'] is not None and _id not in keep}
+        for _id in closed:
+            del self.sessions[_id]
+        for event_id, _id in list(self.aliases.items()):
+            if _id in closed or _id not in self.sessions:
+                del self.aliases[event_id]
+                self.set_state("alias", event_id, None)
+    
+    def compact_sessions(self, chunk=200):
+        """
+        Rewrites every stored session document with its app entries repaired and compacted.
+
+        Documents written before app entries were updated in place hold every window
+        twice once closed, and one entry per update event. The counters and rollups are
+        adjusted by the same deltas as for an event, in the same MULTI, and the documents
+        are watched so this can run while the aggregator is live. Open and recent
+        sessions are left alone, the aggregator holds them in memory and compacts them
+        as it goes.
+        """
+        held = set(self.client.smembers(OPEN_KEY))
+        for key in self.client.scan_iter(f"{STATE_KEY}*"):
+            held.update(value for field, value in self.client.hgetall(key).items() if field.startswith("recent:"))
+        ids = sorted(set(self.client.smembers("sessions")) - held)
+        for i in range(0, len(ids), chunk):
+            keys = [f"sessions:{_id}" for _id in ids[i:i + chunk]]
+            done = False
+            while not done:
+                self.rollover()
+                
+                def compact(pipe):
+                    nonlocal done
+                    if pipe.get("agg:day") != self.day.isoformat():
+                        return
+                    docs = pipe.json().mget(keys, ".")
+                    deltas = {}
+                    buckets = {}
+                    rewrites = {}
+                    for key, doc in zip(keys, docs):
+                        if not doc or doc['end'] is None:
+                            continue
+                        compacted = dict(doc, apps=compact_apps(normalize_apps(doc)))
+                        if compacted == doc:
+                            continue
+                        for (before, after, totals) in (
+                            (self.contribution(doc), self.contribution(compacted), deltas),
+                            (rollups.allocate(doc), rollups.allocate(compacted), buckets),
+                        ):
+                            for k in before.keys() | after.keys():
+                                totals[k] = totals.get(k, 0) + after.get(k, 0) - before.get(k, 0)
+                        rewrites[key] = compacted
+                    pipe.multi()
+                    for key, doc in rewrites.items():
+                        pipe.json().set(key, "$", doc)
+                    for key, delta in deltas.items():
+                        if delta:
+                            pipe.incrby(key, delta)
+                    for (key, field), delta in buckets.items():
+                        if delta:
+                            pipe.hincrby(key, field, delta)
+                    done = True
+                    if rewrites:
+                        pipe.incr(DATA_VERSION_KEY)
+                        print(f"Compacted {len(rewrites)} sessions")
+                
+                self.client.transaction(compact, "agg:day", *keys)
+    
+    def process_event(self, event):
+        self.process_batch([(None, event)])
+        self.flush()
+            
+    def print_totals(self):
+        keys = sorted(self.client.smembers(COUNTERS_KEY))
+        values = dict(zip(keys, self.client.mget(keys))) if keys else {}
+        print("New totals: ")
+        for key in keys:
+            if key.startswith("agg:total:"):
+                print(f"{key}: {values[key]}")
             
-                # Calculate totals per classification for today
-                sessions = self.client.smembers("sessions")
-                # clear the totals
-                for key in self.client.scan_iter("agg:total:*"):
-                    self.client.delete(key)
+        print("New app totals: ")
+        for key in keys:
+            if key.startswith("agg:app:"):
+                print(f"{key}: {values[key]}")
+    
+    def next_count(self, count, received):
+        """Grows the read size while a backlog fills every read, and shrinks it back once caught up."""
+        if received >= count:
+            return min(count * 2, self.batch_size)
+        return self.count
+    
+    def run(self):
+        last_id = self.client.get("agg:last_id") or 0
+        self.recover()
+        count = self.count
+        catching_up = False
+        try:
+            while True:
+                self.rollover()
+                if self.retention:
+                    self.retention.maintain()
+                # Block until something happens, unless a backlog is still being drained
+                itm = self.client.xread(
+                    streams={"activity": last_id}, count=count, block=None if catching_up else self.block
+                )
+                entries = itm[0][1] if itm else []
                 
-                # Calculate totals per app
-                for key in self.client.scan_iter("agg:app:*"):
-                    self.client.delete(key)
-                    
-                for session in sessions:
-                    session = self.client.json().get(f"sessions:{session}")
-                    if self.today(session['end']):
-                        self.client.incr(f"agg:total:{session['classification']}", int(session['duration']))
-
-                        for app in session['apps']:
-                            self.client.incr(f"agg:app:{app['name']}", int(app['duration']))
-                    
+                if entries:
+                    print(f"itm: {len(entries)} events up to {entries[-1][0]}")
+                    self.process_batch(self.decoder.decode(entries))
+                    last_id = entries[-1][0]
                 
-                print("New totals: ")
-                for key in self.client.scan_iter("agg:total:*"):
-                    print(f"{key}: {self.client.get(key)}")
-                    
-                print("New app totals: ")
-                for key in self.client.scan_iter("agg:app:*"):
-                    print(f"{key}: {self.client.get(key)}")
-                time.sleep(5)
-            time.sleep(15)
+                catching_up = len(entries) >= count
+                count = self.next_count(count, len(entries))
+                # Everything is written before waiting for more
+                if not catching_up or self.flush_due():
+                    self.flush()
+                if entries and not catching_up:
+                    self.print_totals()
+        finally:
+            self.flush()
+    
+    def acquire_lease(self, key, consumer, ttl):
+        """Takes the lease if it is free, or renews it if this consumer already holds it. Returns whether it is held."""
+        if self.client.set(key, consumer, nx=True, px=ttl):
+            return True
+        return self.renew_lease(key, consumer, ttl)
+    
+    def renew_lease(self, key, consumer, ttl):
+        """Extends the lease by ttl milliseconds, if this consumer still holds it."""
+        def renew(pipe):
+            if pipe.get(key) != consumer:
+                return False
+            pipe.multi()
+            pipe.pexpire(key, ttl)
+            return True
+        
+        return self.client.transaction(renew, key, value_from_callable=True)
+    
+    def release_lease(self, key, consumer):
+        def release(pipe):
+            if pipe.get(key) == consumer:
+                pipe.multi()
+                pipe.delete(key)
+        
+        self.client.transaction(release, key)
+    
+    def run_group(self, consumer, group="aggregators", partition=0, partitions=1, lease_ttl=30000):
+        """
+        Consumes the activity stream through a consumer group.
+
+        Sessions are partitioned by id: each partition is its own consumer group over
+        the whole stream, so several workers (one per partition) can run at once and
+        every session is still processed in order by a single worker. Every partition
+        still reads the whole stream, but entries of other partitions are acknowledged
+        without being decoded or processed.
+
+        A window only continues the recent session of its classification held by the
+        same partition, so with several partitions fewer sessions are merged than by
+        run() and the session documents differ. The per-app counters and rollups are
+        the same, the per-classification ones can differ, as a session's whole duration
+        counts towards its current classification. rebuild.py reproduces run(), and
+        refuses to rebuild a partitioned deployment.
+
+        Only the holder of the partition's lease (agg:lease:<group>) consumes it. Other
+        workers started for the same partition wait until the lease expires, then claim
+        every pending entry of the group and process them in stream order before reading
+        new ones. The lease is renewed before every read, so lease_ttl has to be longer
+        than the block time. A worker that loses the lease drops what it hasn't flushed
+        and waits again; entries it read after losing it are claimed by the new holder
+        once they have been idle for lease_ttl. Consumer names should stay the same
+        across restarts (the host name by default), so a restarted worker reads its own
+        pending entries back.
+
+        Args:
+            consumer (str): The name of this consumer, unique within its partition.
+            group (str): The consumer group name prefix.
+            partition (int): The partition of session ids this worker handles.
+            partitions (int): The total number of partitions.
+            lease_ttl (int): How long the lease outlives the last renewal of its holder, in milliseconds.
+        """
+        if partitions > 1:
+            group = f"{group}:{partition}/{partitions}"
+        try:
+            # A new group starts where the single-process run() left off
+            self.client.xgroup_create("activity", group, id=self.client.get("agg:last_id") or 0, mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        
+        self.group = group
+        lease_key = f"{LEASE_KEY}:{group}"
+        try:
+            while True:
+                if not self.acquire_lease(lease_key, consumer, lease_ttl):
+                    time.sleep(lease_ttl / 4000)
+                    continue
+                print(f"Consuming {group} as {consumer}")
+                self.lease = (lease_key, consumer)
+                try:
+                    self.consume_group(consumer, partition, partitions, lease_ttl)
+                except LeaseLost:
+                    print(f"Lost the lease of {group}, waiting for it")
+                finally:
+                    self.lease = None
+        finally:
+            self.release_lease(lease_key, consumer)
+    
+    def claim_pending(self, consumer):
+        """Moves every pending entry of the group to this consumer, whoever read it before."""
+        start = "0-0"
+        claimed = 0
+        while True:
+            next_start, entries = self.client.xautoclaim("activity", self.group, consumer, 0, start_id=start, count=self.batch_size)[:2]
+            claimed += len(entries)
+            if next_start == "0-0":
+                break
+            start = next_start
+        if claimed:
+            print(f"Claimed {claimed} pending entries")
+    
+    def consume_group(self, consumer, partition, partitions, lease_ttl):
+        """Processes the group's entries for as long as this worker holds the lease."""
+        self.recover(partition, partitions)
+        # The entries read before by this or a previous holder but never acknowledged come first, in stream order
+        self.claim_pending(consumer)
+        backlog = "0"
+        last_claim = time.time()
+        count = self.count
+        catching_up = False
+        lost = False
+        try:
+            while True:
+                if not self.renew_lease(*self.lease, lease_ttl):
+                    raise LeaseLost(self.lease[0])
+                self.rollover()
+                if self.retention:
+                    self.retention.maintain()
+                entries = []
+                if backlog:
+                    # Pending entries stay pending until flushed, so the backlog is read from the last one read
+                    itm = self.client.xreadgroup(self.group, consumer, {"activity": backlog}, count=count)
+                    entries = itm[0][1] if itm else []
+                    backlog = entries[-1][0] if entries else None
+                if not entries and time.time() - last_claim >= lease_ttl / 1000:
+                    last_claim = time.time()
+                    # Entries a former holder read after its lease expired stay pending under its name
+                    entries = self.client.xautoclaim("activity", self.group, consumer, lease_ttl, count=count)[1]
+                    if entries:
+                        print(f"Claimed {len(entries)} entries left by a former holder")
+                if not entries:
+                    itm = self.client.xreadgroup(
+                        self.group, consumer, {"activity": ">"}, count=count, block=None if catching_up else self.block
+                    )
+                    entries = itm[0][1] if itm else []
+                catching_up = len(entries) >= count
+                count = self.next_count(count, len(entries))
+                
+                if entries:
+                    # Only this partition's entries are decoded, the others are just acknowledged
+                    mine = [(_id, fields) for (_id, fields) in entries if partition_of(event_id(fields), partitions) == partition]
+                    # Entries deleted from the stream come back without data and decode to None
+                    mine = [(_id, event) for (_id, event) in self.decoder.decode(mine) if event]
+                    print(f"itm: {len(mine)}/{len(entries)} events up to {entries[-1][0]}")
+                    self.process_batch(mine, ack=[_id for (_id, _) in entries])
+                # Everything is written and acknowledged before waiting for more
+                if not catching_up or self.flush_due():
+                    self.flush()
+        except LeaseLost:
+            # The new holder replays whatever wasn't flushed from the pending entries
+            lost = True
+            raise
+        finally:
+            if not lost:
+                self.flush()
+
+
+class LeaseLost(Exception):
+    """Another consumer took over the partition this worker was consuming."""
+
+
+class SessionRecord(object):
+    """A session held in memory: its current document, and the one last written to Redis."""
+    
+    __slots__ = ("doc", "stored")
+    
+    def __init__(self, doc, stored):
+        self.doc = doc
+        self.stored = stored
+
+
+# The most app entries a session document keeps, see compact_apps
+MAX_APPS = 50
+
+# Classification of the windows the stalker hasn't classified yet, followed by a reclassify event
+PENDING_CLASSIFICATION = "Pending"
+
+# Ids of the sessions still open, so a restart only loads those
+OPEN_KEY = "sessions:open"
+# Hash of the aggregator's recent:<classification> sessions and alias:<event id> merges
+STATE_KEY = "agg:state"
+# Set of the agg:total:* / agg:app:* counter keys of the current day, so reading them never scans the keyspace
+COUNTERS_KEY = "agg:counters"
+# Prefix of the lease key of each consumer group, held by the one consumer processing its partition
+LEASE_KEY = "agg:lease"
+# Bumped in every MULTI that changes the sessions, counters or rollups, so readers know when their copies are stale
+DATA_VERSION_KEY = "agg:data_version"
+
+
+def counter_keys(client):
+    """The keys of the day's counters, from agg:counters once it exists, by scanning the keyspace before that."""
+    if client.exists(COUNTERS_KEY):
+        return list(client.smembers(COUNTERS_KEY))
+    return list(client.scan_iter("agg:total:*")) + list(client.scan_iter("agg:app:*"))
+
+
+def close_apps(apps, timestamp):
+    """Closes the open app entries of a session at timestamp."""
+    for app in apps:
+        if app['end'] is None:
+            app['end'] = timestamp
+            app['duration'] = int(max(0, timestamp - app['start']))
+
+
+def merge_apps(first, second):
+    """One entry for two contiguous closed entries of the same app, the second one's window winning."""
+    return keep_shares(dict(
+        second,
+        start=first['start'],
+        duration=first['duration'] + second['duration'],
+        screenshot=second['screenshot'] or first['screenshot'],
+        entries=first.get('entries', 1) + second.get('entries', 1),
+    ), [first, second])
+
+
+def keep_shares(app, parts):
+    """
+    Keeps on a closed entry merged from parts the rollup shares they were allocated,
+    whenever its own interval would spread its seconds differently, so merging never
+    moves seconds between rollup buckets.
+    """
+    shares = {}
+    for part in parts:
+        for key, seconds in rollups.entry_shares(part).items():
+            shares[key] = shares.get(key, 0) + seconds
+    app.pop('shares', None)
+    if shares != rollups.entry_shares(app):
+        app['shares'] = shares
+    return app
+
+
+def normalize_apps(doc):
+    """
+    Repairs the app entries of a document written before they were updated in place.
+
+    Closing a session used to append a closed copy of every open entry, and
+    every update event opened another entry for the same window. The copies
+    are dropped, and every entry but the last is closed when the next one
+    starts, or when the session ended.
+    """
+    closed = {(app['name'], app['title'], app['start']) for app in doc['apps'] if app['end'] is not None}
+    apps = {}
+    for app in doc['apps']:
+        key = (app['name'], app['title'], app['start'])
+        if app['end'] is None and key in closed:
+            continue
+        apps.setdefault(key, dict(app))
+    apps = sorted(apps.values(), key=lambda app: app['start'])
+    for app, following in zip(apps, apps[1:] + [None]):
+        if 'entries' in app:
+            # Already compacted, possibly spanning other entries
+            continue
+        end = following['start'] if following else doc['end']
+        if end is not None and (app['end'] is None or app['end'] > end):
+            app['end'] = end
+            app['duration'] = int(max(0, end - app['start']))
+    return apps
+
+
+def compact_apps(apps, max_apps=MAX_APPS):
+    """
+    Bounds the app entries of a session, keeping the seconds per app and per
+    rollup bucket unchanged.
+
+    Contiguous closed entries of the same window are merged first. Past max_apps,
+    contiguous closed entries of the same app are merged whatever their window,
+    and if that is still not enough the oldest entries are folded into one summary
+    entry per app, spanning them, with their summed duration and the rollup shares
+    they were allocated (see keep_shares).
+    """
+    def merge_contiguous(apps, same):
+        merged = []
+        for app in apps:
+            prev = merged[-1] if merged else None
+            # Open entries are only merged once closed, their shares aren't final yet
+            if prev and prev['end'] is not None and app['end'] is not None and prev['end'] == app['start'] and same(prev, app):
+                merged[-1] = merge_apps(prev, app)
+            else:
+                merged.append(app)
+        return merged
+    
+    apps = merge_contiguous(apps, lambda a, b: (a['name'], a['title']) == (b['name'], b['title']))
+    if len(apps) > max_apps:
+        apps = merge_contiguous(apps, lambda a, b: a['name'] == b['name'])
+    if len(apps) > max_apps:
+        # Fold the oldest closed entries, as few as needed to fit with one summary per app among them
+        closed = len(apps) - 1 if apps[-1]['end'] is None else len(apps)
+        count = len(apps) - max_apps
+        while count < closed and len(apps) - count + len({app['name'] for app in apps[:count]}) > max_apps:
+            count += 1
+        count = min(count, closed)
+        folded = {}
+        for app in apps[:count]:
+            summary = folded.get(app['name'])
+            folded[app['name']] = keep_shares(dict(
+                app,
+                title=None,
+                screenshot=None,
+                start=min(summary['start'], app['start']) if summary else app['start'],
+                end=max(summary['end'], app['end']) if summary else app['end'],
+                duration=(summary['duration'] if summary else 0) + app['duration'],
+                entries=(summary['entries'] if summary else 0) + app.get('entries', 1),
+            ), [summary, app] if summary else [app])
+        apps = sorted(folded.values(), key=lambda app: app['start']) + apps[count:]
+    return apps
+
+
+def write_session(pipe, key, stored, doc):
+    """
+    Queues the writes turning the stored session document into doc.
+
+    Only the fields and app entries that changed are written, new entries are
+    appended, and the whole document is only rewritten when it is new or its
+    apps were compacted.
+    """
+    apps = (stored or {}).get('apps') or []
+    changed = [i for i, app in enumerate(doc['apps'][:len(apps)]) if app != apps[i]]
+    if not stored or len(doc['apps']) < len(apps) or len(changed) > 2:
+        pipe.json().set(key, "$", doc)
+        return
+    for field, value in doc.items():
+        if field != 'apps' and stored.get(field) != value:
+            pipe.json().set(key, f"$.{field}", value)
+    for i in changed:
+        pipe.json().set(key, f"$.apps[{i}]", doc['apps'][i])
+    if len(doc['apps']) > len(apps):
+        pipe.json().arrappend(key, "$.apps", *doc['apps'][len(apps):])
+
+
+def partition_of(session_id, partitions):
+    """Maps a session id to a stable partition number."""
+    return zlib.crc32(str(session_id).encode()) % partitions
+
+
 if __name__ == "__main__":
-    agg = Aggregator()
+    parser = argparse.ArgumentParser(description="Aggregates activity events into sessions and totals.")
+    parser.add_argument("--group", help="consume the stream through this consumer group instead of agg:last_id")
+    parser.add_argument("--consumer", default=socket.gethostname(), help="stable across restarts, so pending entries are read back")
+    parser.add_argument("--partition", type=int, default=0)
+    parser.add_argument("--partitions", type=int, default=1)
+    parser.add_argument("--lease-ttl", type=int, default=30000, help="milliseconds before a standby takes over a partition from a dead consumer")
+    parser.add_argument("--block", type=int, default=5000, help="milliseconds an idle read waits for new events")
+    parser.add_argument("--count", type=int, default=100, help="events per read while keeping up")
+    parser.add_argument("--batch-size", type=int, default=1000, help="events per read while catching up")
+    parser.add_argument("--retain", type=float, help="trim processed events older than this many seconds from the stream, never by default")
+    parser.add_argument("--archive-dir", help="archive events to segment files here before trimming them")
+    parser.add_argument("--flush-interval", type=float, default=1.0, help="seconds between writes while catching up")
+    parser.add_argument("--compact", action="store_true", help="repair and compact the stored sessions, then exit")
+    args = parser.parse_args()
+    
+    agg = Aggregator(
+        batch_size=args.batch_size,
+        count=args.count,
+        block=args.block,
+        retain=args.retain,
+        archive_dir=args.archive_dir,
+        flush_interval=args.flush_interval,
+    )
     
-    agg.run()
\ No newline at end of file
+    if args.compact:
+        agg.compact_sessions()
+    elif args.group:
+        agg.run_group(args.consumer, args.group, args.partition, args.partitions, args.lease_ttl)
+    else:
+        agg.run()
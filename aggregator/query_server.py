@@ -0,0 +1,193 @@
+import argparse
+import json
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from redis import Redis
+import rollups
+import sessions_index
+from main import DATA_VERSION_KEY, counter_keys
+
+# Read-only HTTP API over the aggregates, for the dashboard.
+#
+#   GET /totals                                 today's counters, per classification and per app
+#   GET /apps?day=YYYY-MM-DD                    seconds per app on a day, open sessions included
+#   GET /rollups?start=&end=&granularity=hour   rollups.query over [start, end)
+#   GET /timeline?start=&end=&limit=&cursor=    the session documents overlapping [start, end)
+#
+# Timestamps are epoch seconds; days and ranges default to today. Responses are cached in memory
+# until the aggregator bumps agg:data_version, which it does in every MULTI that changes what is
+# served here. That key is read at most once per check interval however many clients there are,
+# and responses carry an ETag derived from it, so an unchanged page costs a 304 and no Redis reads.
+
+
+class QueryCache(object):
+    def __init__(self, client, check_interval=0.5, max_entries=256):
+        """
+        Args:
+            client (Redis): The Redis client.
+            check_interval (float): The seconds a read of the data version is trusted for.
+            max_entries (int): The most responses kept, least recently used ones are dropped first.
+        """
+        self.client = client
+        self.check_interval = check_interval
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # request key -> (version, etag, body)
+        self.version = None
+        self.checked = 0
+        self.lock = threading.Lock()
+
+    def current_version(self):
+        with self.lock:
+            if time.time() - self.checked >= self.check_interval:
+                self.version = self.client.get(DATA_VERSION_KEY) or "0"
+                self.checked = time.time()
+            return self.version
+
+    def get(self, key, compute):
+        """
+        Returns:
+            tuple: The ETag and JSON body of a response, computed only if the data changed since it was cached.
+        """
+        version = self.current_version()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] == version:
+                self.entries.move_to_end(key)
+                return entry[1], entry[2]
+
+        body = json.dumps(compute(self.client)).encode()
+        etag = f'"{version}-{zlib.crc32(repr(key).encode()):08x}"'
+        with self.lock:
+            self.entries[key] = (version, etag, body)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return etag, body
+
+
+def day_range(day):
+    start = datetime.combine(day, datetime.min.time())
+    return start.timestamp(), (start + timedelta(days=1)).timestamp()
+
+
+def totals(client):
+    """The agg:total:* and agg:app:* counters, for the day in agg:day."""
+    keys = counter_keys(client)
+    values = dict(zip(keys, client.mget(keys))) if keys else {}
+    return {
+        "day": client.get("agg:day"),
+        "classifications": {k[len("agg:total:"):]: int(v) for k, v in values.items() if k.startswith("agg:total:") and v},
+        "apps": {k[len("agg:app:"):]: int(v) for k, v in values.items() if k.startswith("agg:app:") and v},
+    }
+
+
+def apps(day):
+    def compute(client):
+        values = client.hgetall(rollups.DAILY_KEY.format(day.isoformat()))
+        seconds = {field[len("app:"):]: int(v) for field, v in values.items() if field.startswith("app:")}
+        return {"day": day.isoformat(), "apps": dict(sorted(seconds.items(), key=lambda item: -item[1]))}
+    return compute
+
+
+def rollup(start, end, granularity):
+    def compute(client):
+        return [{"start": bucket, "values": values} for bucket, values in rollups.query(client, start, end, granularity)]
+    return compute
+
+
+def timeline(start, end, limit, cursor):
+    def compute(client):
+        if not sessions_index.is_indexed(client):
+            raise LookupError("the sessions index isn't built yet, run sessions_index.py")
+        ids, next_cursor = sessions_index.overlapping(client, start, end, limit, cursor)
+        docs = client.json().mget([f"sessions:{_id}" for _id in ids], ".") if ids else []
+        return {
+            "sessions": [dict(doc, id=_id) for _id, doc in zip(ids, docs) if doc],
+            "cursor": next_cursor,
+        }
+    return compute
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    cache = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            key, compute = self.route(url.path, params)
+        except KeyError:
+            return self.send_error(404)
+        except ValueError as e:
+            return self.send_error(400, str(e))
+
+        try:
+            etag, body = self.cache.get(key, compute)
+        except LookupError as e:
+            return self.send_error(503, str(e))
+        if etag in (tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def route(self, path, params):
+        """
+        Returns:
+            tuple: The cache key of the request, and the function computing its response from a Redis client.
+        """
+        today = date.today()
+        if path == "/totals":
+            # Keyed by day too, so the first request after midnight isn't served yesterday's counters
+            return (path, today), totals
+        if path == "/apps":
+            day = date.fromisoformat(params["day"]) if "day" in params else today
+            return (path, day), apps(day)
+
+        default_start, default_end = day_range(today)
+        start = float(params.get("start", default_start))
+        end = float(params.get("end", default_end))
+        if end < start:
+            raise ValueError("end is before start")
+        if path == "/rollups":
+            granularity = params.get("granularity", "hour")
+            if granularity not in ("hour", "day", "week"):
+                raise ValueError(f"Unknown granularity: {granularity}")
+            return (path, start, end, granularity), rollup(start, end, granularity)
+        if path == "/timeline":
+            limit = min(int(params.get("limit", 100)), 1000)
+            if limit < 1:
+                raise ValueError("limit must be at least 1")
+            cursor = int(params.get("cursor", 0))
+            if cursor < 0:
+                raise ValueError("cursor can't be negative")
+            return (path, start, end, limit, cursor), timeline(start, end, limit, cursor)
+        raise KeyError(path)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves the aggregated activity to the dashboard.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--check-interval", type=float, default=0.5, help="seconds between reads of the data version")
+    args = parser.parse_args()
+
+    QueryHandler.cache = QueryCache(Redis(decode_responses=True), args.check_interval)
+    server = ThreadingHTTPServer((args.host, args.port), QueryHandler)
+    print(f"Serving on http://{args.host}:{args.port}")
+    server.serve_forever()
@@ -0,0 +1,352 @@
+import argparse
+import os
+import re
+import time
+from datetime import datetime
+from multiprocessing import Pool
+from redis import Redis, SSLConnection
+import rollups
+import sessions_index
+from events import EventDecoder
+from main import Aggregator, COUNTERS_KEY, DATA_VERSION_KEY, OPEN_KEY, PENDING_CLASSIFICATION, STATE_KEY
+from retention import LOST_ID_KEY, STREAM, TRIM_ID_KEY, read_segments
+
+# Rebuilds the sessions, counters, rollups, index and aggregator state from the activity stream,
+# and its archived segments, without touching the live keys until the end.
+#
+# Sessions only depend on each other through the aggregator's recent session per classification
+# and its aliases, so a first sequential pass tracks just that (which session each event goes to)
+# and splits the events into one chain per session. The chains are then replayed with
+# Aggregator.apply_event in a process pool, each worker writing its documents straight into a
+# staging keyspace under the prefix. Finally the live keys are replaced by the staged ones in a
+# single MULTI, watched so it is abandoned if an aggregator wrote anything in the meantime.
+#
+# The result is what Aggregator.process_event, writing every event as it goes, produces for the
+# same entries. Consumer groups aren't rebuilt: the state is written for the single-process
+# aggregator (agg:state and agg:last_id), groups have to be recreated from agg:last_id. Partitioned
+# groups merge fewer windows into sessions than a single process (see Aggregator.run_group), so a
+# rebuild would rewrite their session history and is refused unless forced.
+PREFIX = "rebuild:"
+# The live keys replaced by a rebuild
+LIVE_PATTERNS = ("sessions", "sessions:*", "agg:total:*", "agg:app:*", "agg:hourly:*", "agg:daily:*", f"{STATE_KEY}*",
+                 "agg:day", "agg:last_id", COUNTERS_KEY)
+
+
+def read_events(client, archive_dir=None, chunk=10000):
+    """
+    Yields the (stream id, event) entries of the archived segments, then of the stream.
+
+    Entries that are both archived and still in the stream are only yielded once.
+    """
+    decoder = EventDecoder(client)
+    last = None
+    if archive_dir:
+        entries = []
+        for entry in read_segments(archive_dir):
+            entries.append(entry)
+            last = entry[0]
+            if len(entries) == chunk:
+                yield from decoder.decode(entries)
+                entries = []
+        yield from decoder.decode(entries)
+    start = f"({last}" if last else "-"
+    while True:
+        entries = client.xrange(STREAM, start, "+", count=chunk)
+        if not entries:
+            return
+        yield from decoder.decode(entries)
+        start = f"({entries[-1][0]}"
+
+
+def plan(entries):
+    """
+    Works out which session every event is applied to, the way Aggregator.process_batch does.
+
+    Only the classification and end of the sessions held in memory are tracked, not their
+    documents, so this is cheap enough to run sequentially over the whole history.
+
+    Returns:
+        tuple: The chains, {session id: [(continues, event), ...]} in stream order, where
+        continues says whether the event applies to the session's current document or starts a
+        new one; the recent sessions and aliases left at the end; and the last stream id.
+    """
+    chains = {}
+    stored = {}  # session id -> [classification, end] of every session written
+    held = {}  # the same, for the sessions the aggregator keeps in memory
+    aliases, recent = {}, {}
+    position = None
+    for stream_id, event in entries:
+        position = stream_id
+        if not event or not event.get("id"):
+            continue
+        event_id = event['id']
+        # Reclassifications target their own session, see Aggregator.session_of
+        _id = event_id if event.get('reclassify') else aliases.get(event_id, event_id)
+        if not event['state'] and _id not in held and event_id in stored:
+            # Loaded from Redis to be closed
+            held[event_id] = stored[event_id]
+
+        continues = _id in held
+        if not continues and event['state']:
+            _id = event_id
+            # A window right after a session of the same classification continues it
+            last = recent.get(event['classification'])
+            if (last in held and held[last] == [event['classification'], event['timestamp']]
+                    and event['classification'] != PENDING_CLASSIFICATION):
+                _id, continues = last, True
+
+        if event.get('reclassify'):
+            if continues and held[_id][0] == PENDING_CLASSIFICATION:
+                chains[_id].append((True, event))
+                held[_id] = stored[_id] = [event['classification'], held[_id][1]]
+        elif continues or event['state']:
+            chains.setdefault(_id, []).append((continues, event))
+            if event['state']:
+                session = [event['classification'], None]
+            else:
+                session = [held[_id][0], event['timestamp']]
+            held[_id] = stored[_id] = session
+            if _id != event_id:
+                aliases[event_id] = _id
+            if session[1] is not None:
+                recent[session[0]] = _id
+
+        # What flush() forgets after every event
+        keep = set(recent.values())
+        for closed in [s for s, (_, end) in held.items() if end is not None and s not in keep]:
+            del held[closed]
+        for alias, target in list(aliases.items()):
+            if target not in held:
+                del aliases[alias]
+    return chains, recent, aliases, position
+
+
+worker = None
+
+
+def connection_args(client):
+    """The arguments connecting a new client to the same server and database as client, for the workers."""
+    pool = client.connection_pool
+    args = {name: value for name, value in pool.connection_kwargs.items() if name in ("host", "port", "db", "username", "password")}
+    if "path" in pool.connection_kwargs:
+        args["unix_socket_path"] = pool.connection_kwargs["path"]
+    if issubclass(pool.connection_class, SSLConnection):
+        args["ssl"] = True
+    return args
+
+
+def replay(args):
+    """
+    Replays chains of events into session documents in the staging keyspace.
+
+    Returns:
+        tuple: The index entries of the sessions, the ids of the open ones, and their
+        contributions to the day's counters and to the rollups.
+    """
+    global worker
+    connection, prefix, day, chains = args
+    if worker is None:
+        # The pool's workers connect to the server the rebuild reads from, not a default one
+        worker = Aggregator(retain=None, client=Redis(decode_responses=True, **connection))
+    worker.day = day
+
+    index = []
+    open_ids = []
+    totals = {}
+    buckets = {}
+    pipe = worker.client.pipeline(transaction=False)
+    for _id, steps in chains:
+        doc = None
+        for continues, event in steps:
+            _, applied = worker.apply_event(doc if continues else None, None, event)
+            doc = applied or doc
+        pipe.json().set(f"{prefix}sessions:{_id}", "$", doc)
+        if len(pipe) >= 1000:
+            pipe.execute()
+        index.append((_id, doc['start'], doc['end'], doc['duration']))
+        if doc['end'] is None:
+            open_ids.append(_id)
+        for key, value in worker.contribution(doc).items():
+            totals[key] = totals.get(key, 0) + value
+        for key, value in rollups.allocate(doc).items():
+            buckets[key] = buckets.get(key, 0) + value
+    pipe.execute()
+    return index, open_ids, totals, buckets
+
+
+def stage(client, prefix, chains, recent, aliases, position, processes=None):
+    """Writes everything a rebuild produces under prefix, replaying the chains in a process pool."""
+    day = datetime.now().date()
+    processes = processes or os.cpu_count() or 1
+    # Striped over many more jobs than processes, so long chains don't leave workers idle
+    items = list(chains.items())
+    jobs = max(1, min(len(items), processes * 8))
+    connection = connection_args(client)
+    work = [(connection, prefix, day, items[i::jobs]) for i in range(jobs)]
+
+    pipe = client.pipeline(transaction=False)
+    totals, buckets, span = {}, {}, 0
+    with Pool(processes) as pool:
+        for index, open_ids, job_totals, job_buckets in pool.imap(replay, work):
+            for _id, start, end, duration in index:
+                pipe.sadd(f"{prefix}sessions", _id)
+                pipe.zadd(f"{prefix}{sessions_index.BY_START_KEY}", {_id: start})
+                pipe.zadd(f"{prefix}{sessions_index.BY_END_KEY}", {_id: end if end is not None else float("inf")})
+                span = max(span, duration, (end or start) - start)
+            if open_ids:
+                pipe.sadd(f"{prefix}{OPEN_KEY}", *open_ids)
+            pipe.execute()
+            for key, value in job_totals.items():
+                totals[key] = totals.get(key, 0) + value
+            for key, value in job_buckets.items():
+                buckets[key] = buckets.get(key, 0) + value
+
+    if chains:
+        pipe.zadd(f"{prefix}{sessions_index.SPAN_KEY}", {"max": span})
+    pipe.set(f"{prefix}{sessions_index.VERSION_KEY}", sessions_index.VERSION)
+    if totals:
+        pipe.mset({f"{prefix}{key}": value for key, value in totals.items()})
+        pipe.sadd(f"{prefix}{COUNTERS_KEY}", *totals)
+    for (key, field), seconds in buckets.items():
+        if seconds:
+            pipe.hset(f"{prefix}{key}", field, seconds)
+    state = {f"recent:{classification}": _id for classification, _id in recent.items()}
+    state.update({f"alias:{event_id}": _id for event_id, _id in aliases.items()})
+    pipe.hset(f"{prefix}{STATE_KEY}", mapping=dict(state, version=1))
+    pipe.set(f"{prefix}agg:day", day.isoformat())
+    if position is not None:
+        pipe.set(f"{prefix}agg:last_id", position)
+    pipe.execute()
+
+
+def missing_history(client, archive_dir, chains):
+    """
+    Says why the events that can be replayed don't reach back to the start of history, or None if they do.
+
+    The retention records in agg:lost_id how far entries were trimmed without being archived, and
+    in agg:trim_id how far they were trimmed at all. Whatever the keys say, sessions already stored
+    must not start before the first event replayed.
+    """
+    lost = client.get(LOST_ID_KEY)
+    if lost:
+        return f"the stream entries before {lost} were trimmed without being archived"
+    trim_id = client.get(TRIM_ID_KEY)
+    if trim_id and not archive_dir:
+        return f"the stream entries before {trim_id} were trimmed, pass the --archive-dir they were archived to"
+    if trim_id and next(read_segments(archive_dir), None) is None:
+        return f"the stream entries before {trim_id} were trimmed and {archive_dir} holds no archived segments"
+
+    earliest = client.zrange(sessions_index.BY_START_KEY, 0, 0, withscores=True)
+    first = min((steps[0][1]['timestamp'] for steps in chains.values()), default=None)
+    if earliest and (first is None or earliest[0][1] < first):
+        return f"sessions from {datetime.fromtimestamp(earliest[0][1])} are older than the first event left to replay"
+    return None
+
+
+def partitioned_groups(client):
+    """The consumer groups of the stream that each handle one of several partitions."""
+    if not client.exists(STREAM):
+        return []
+    partitioned = []
+    for group in client.xinfo_groups(STREAM):
+        # Named <group>:<partition>/<partitions> by Aggregator.run_group
+        match = re.search(r":\d+/(\d+)$", group["name"])
+        if match and int(match.group(1)) > 1:
+            partitioned.append(group["name"])
+    return partitioned
+
+
+def scan_keys(client, patterns):
+    keys = set()
+    for pattern in patterns:
+        keys.update(client.scan_iter(pattern, count=1000))
+    return sorted(keys)
+
+
+def swap(client, prefix, version):
+    """
+    Replaces the live keys with the staged ones in a single MULTI.
+
+    Returns False, leaving the staged keys in place, if an aggregator changed the live
+    keys since the data version was read.
+    """
+    staged = scan_keys(client, [f"{prefix}*"])
+
+    def replace(pipe):
+        if pipe.get(DATA_VERSION_KEY) != version:
+            raise RuntimeError("the aggregates changed during the rebuild, stop the aggregators and try again")
+        live = scan_keys(pipe, LIVE_PATTERNS)
+        pipe.multi()
+        if live:
+            pipe.unlink(*live)
+        for key in staged:
+            pipe.rename(key, key[len(prefix):])
+        pipe.incr(DATA_VERSION_KEY)
+
+    try:
+        client.transaction(replace, DATA_VERSION_KEY, "agg:last_id")
+    except RuntimeError as e:
+        print(f"Not swapping the rebuild in: {e}")
+        return False
+    return True
+
+
+def rebuild(client, archive_dir=None, processes=None, prefix=PREFIX, force=False):
+    """
+    Rebuilds the aggregates, unless the events left to replay don't cover the whole history or the
+    stream is consumed by partitioned groups.
+
+    Args:
+        client (Redis): The Redis client.
+        archive_dir (str): Where the trimmed entries were archived.
+        processes (int): The worker processes, the number of CPUs by default.
+        prefix (str): Where the rebuild is staged before being swapped in.
+        force (bool): Whether to rebuild from what is left anyway, deleting the older sessions and rollups,
+            and whether to rebuild a partitioned deployment as a single-process one.
+
+    Returns:
+        bool: Whether the rebuild was swapped in.
+    """
+    started = time.time()
+    partitioned = partitioned_groups(client)
+    if partitioned:
+        reason = f"the stream is consumed by the partitioned groups {', '.join(partitioned)}, whose sessions merge differently"
+        if not force:
+            print(f"Not rebuilding: {reason}, the session history would change. Pass --force to rebuild anyway")
+            return False
+        print(f"Rebuilding anyway: {reason}")
+    version = client.get(DATA_VERSION_KEY)
+    stale = scan_keys(client, [f"{prefix}*"])
+    if stale:
+        client.unlink(*stale)
+
+    chains, recent, aliases, position = plan(read_events(client, archive_dir))
+    print(f"Planned {sum(len(steps) for steps in chains.values())} events in {len(chains)} sessions "
+          f"up to {position} in {time.time() - started:.1f}s")
+    missing = missing_history(client, archive_dir, chains)
+    if missing:
+        if not force:
+            print(f"Not rebuilding: {missing}, the older sessions and rollups would be lost. Pass --force to rebuild anyway")
+            return False
+        print(f"Rebuilding anyway: {missing}")
+    stage(client, prefix, chains, recent, aliases, position, processes)
+    print(f"Staged the rebuild under {prefix} in {time.time() - started:.1f}s")
+    if not swap(client, prefix, version):
+        return False
+
+    groups = [group["name"] for group in client.xinfo_groups(STREAM)] if client.exists(STREAM) else []
+    if groups:
+        print(f"Consumer groups {', '.join(groups)} still point at their old positions, recreate them from agg:last_id")
+    print(f"Rebuilt {len(chains)} sessions in {time.time() - started:.1f}s")
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuilds the aggregates from the activity stream. Stop the aggregators first.")
+    parser.add_argument("--archive-dir", help="replay the archived segments in this directory before the stream")
+    parser.add_argument("--processes", type=int, help="worker processes, the number of CPUs by default")
+    parser.add_argument("--prefix", default=PREFIX, help="where the rebuild is staged before being swapped in")
+    parser.add_argument("--force", action="store_true", help="rebuild even if older events can't be replayed, losing what they aggregated, or if the stream is consumed by partitioned groups")
+    args = parser.parse_args()
+
+    rebuild(Redis(decode_responses=True), args.archive_dir, args.processes, args.prefix, args.force)
@@ -0,0 +1,204 @@
+import argparse
+import glob
+import gzip
+import json
+import os
+import time
+from redis import Redis
+
+# Retention of the activity stream.
+#
+# The stream may only lose entries every consumer is done with: each consumer group's
+# oldest pending entry (or the entry after the last one it was delivered), or agg:last_id
+# for the single-process aggregator when there are no groups. A group none of whose consumers
+# read the stream within the retention window is considered abandoned and no longer holds
+# trimming back, so a partition stopped for that long loses the entries trimmed meanwhile.
+# Entries younger than the retention window are kept regardless, for debugging and replays. The oldest id to keep is published in
+# agg:trim_id, which the stalker passes as XADD ... MINID ~ so trimming happens as part of
+# writing, and the aggregator also trims with XTRIM while the stalker is quiet.
+#
+# When an archive directory is set, the entries are first written to gzipped JSON lines
+# segment files, and agg:trim_id only moves past what has been archived. Without one, trimmed
+# entries are gone for good and rebuild.py can no longer replay them, so the aggregator only
+# trims when asked to with --retain.
+STREAM = "activity"
+TRIM_ID_KEY = "agg:trim_id"
+ARCHIVED_ID_KEY = "agg:archived_id"
+# Entries before this id may have been trimmed without being archived, so they can't be replayed
+LOST_ID_KEY = "agg:lost_id"
+LOCK_KEY = "agg:retention:lock"
+
+
+def parse_id(stream_id):
+    ms, _, seq = str(stream_id).partition("-")
+    return int(ms), int(seq or 0)
+
+
+def format_id(stream_id):
+    return f"{stream_id[0]}-{stream_id[1]}"
+
+
+def next_id(stream_id):
+    """The id right after stream_id, for turning an inclusive position into an exclusive bound."""
+    ms, seq = parse_id(stream_id)
+    return (ms, seq + 1)
+
+
+def consumer_bounds(client, idle_limit=None):
+    """
+    Returns the first entry each consumer of the stream still needs, as (ms, seq) tuples.
+
+    Once consumer groups exist, agg:last_id is what the single-process aggregator left
+    behind and is ignored. Groups none of whose consumers read the stream for idle_limit
+    seconds, like the groups of an old partition layout, are skipped with a warning.
+    """
+    try:
+        groups = client.xinfo_groups(STREAM)
+    except Exception:
+        groups = []
+    if not groups:
+        last_id = client.get("agg:last_id")
+        return [next_id(last_id)] if last_id else []
+
+    bounds = []
+    for group in groups:
+        if idle_limit is not None:
+            idle = min((consumer["idle"] for consumer in client.xinfo_consumers(STREAM, group["name"])), default=None)
+            if idle is None or idle > idle_limit * 1000:
+                print(f"WARNING: not waiting for the consumer group {group['name']}, none of its consumers read the "
+                      f"stream in the last {idle_limit:g}s. Destroy it with XGROUP DESTROY if it is no longer used")
+                continue
+        if group["pending"]:
+            bounds.append(parse_id(client.xpending(STREAM, group["name"])["min"]))
+        else:
+            bounds.append(next_id(group["last-delivered-id"]))
+    return bounds
+
+
+def safe_id(client, retain):
+    """
+    Returns the oldest stream id that has to be kept, or None while nothing may be trimmed.
+
+    Args:
+        client (Redis): The Redis client.
+        retain (float): The seconds of recent entries to keep even once they are processed.
+    """
+    bounds = consumer_bounds(client, idle_limit=retain)
+    if not bounds:
+        return None
+    return min(bounds + [(int((time.time() - retain) * 1000), 0)])
+
+
+def segment_path(directory, first, last):
+    return os.path.join(directory, f"{STREAM}-{first.replace('-', '_')}-{last.replace('-', '_')}.jsonl.gz")
+
+
+def archive(client, directory, upto, segment_size=10000):
+    """
+    Writes the entries before upto that haven't been archived yet to segment files.
+
+    Returns:
+        tuple: upto, once everything before it is archived.
+    """
+    os.makedirs(directory, exist_ok=True)
+    archived = client.get(ARCHIVED_ID_KEY)
+    start = f"({archived}" if archived else "-"
+    end = f"({format_id(upto)}"
+    while True:
+        entries = client.xrange(STREAM, start, end, count=segment_size)
+        if not entries:
+            return upto
+        path = segment_path(directory, entries[0][0], entries[-1][0])
+        temp_path = f"{path}.tmp"
+        with gzip.open(temp_path, "wt") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+        os.replace(temp_path, path)
+        client.set(ARCHIVED_ID_KEY, entries[-1][0])
+        print(f"Archived {len(entries)} entries to {path}")
+        start = f"({entries[-1][0]}"
+
+
+def segment_start(path):
+    return parse_id(os.path.basename(path).split("-")[1].replace("_", "-"))
+
+
+def read_segments(directory):
+    """Yields the archived (stream id, fields) entries in stream order."""
+    for path in sorted(glob.glob(os.path.join(directory, f"{STREAM}-*.jsonl.gz")), key=segment_start):
+        with gzip.open(path, "rt") as f:
+            for line in f:
+                stream_id, fields = json.loads(line)
+                yield stream_id, fields
+
+
+class Retention(object):
+    def __init__(self, client, retain=86400, archive_dir=None, interval=60):
+        """
+        Args:
+            client (Redis): The Redis client.
+            retain (float): The seconds of processed entries to keep in the stream.
+            archive_dir (str): Where to archive entries before they are trimmed, or None to drop them.
+            interval (float): The seconds between two trims.
+        """
+        self.client = client
+        self.retain = retain
+        self.archive_dir = archive_dir
+        self.interval = interval
+        self.last_run = 0
+        if not archive_dir:
+            print(f"WARNING: trimming the activity stream after {retain:g}s without an archive directory, "
+                  f"older events will be deleted for good and can't be replayed or rebuilt")
+
+    def maintain(self, force=False):
+        """Archives and trims the stream, at most once per interval and by one aggregator at a time."""
+        if not force and time.time() - self.last_run < self.interval:
+            return
+        self.last_run = time.time()
+        # Only one aggregator archives at a time, or segments would be written twice
+        if not self.client.set(LOCK_KEY, os.getpid(), nx=True, px=int(self.interval * 1000) or 1000):
+            return
+        try:
+            upto = safe_id(self.client, self.retain)
+            if upto is None:
+                return
+            if self.archive_dir:
+                if not self.client.exists(ARCHIVED_ID_KEY) and self.client.exists(TRIM_ID_KEY):
+                    # Archiving starts on a stream already trimmed without it
+                    self.client.setnx(LOST_ID_KEY, self.client.get(TRIM_ID_KEY))
+                upto = archive(self.client, self.archive_dir, upto)
+            trim_id = format_id(upto)
+            if not self.archive_dir and self.client.xrange(STREAM, "-", f"({trim_id}", count=1):
+                self.client.set(LOST_ID_KEY, trim_id)
+            self.client.set(TRIM_ID_KEY, trim_id)
+            trimmed = self.client.xtrim(STREAM, minid=trim_id, approximate=True)
+            if trimmed:
+                print(f"Trimmed {trimmed} entries before {trim_id}")
+        except Exception as e:
+            print(f"Error trimming the activity stream: {e}")
+        finally:
+            self.client.delete(LOCK_KEY)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Trims the activity stream, or restores archived entries.")
+    parser.add_argument("--retain", type=float, default=86400, help="seconds of processed entries to keep")
+    parser.add_argument("--archive-dir", help="archive entries here before trimming them")
+    parser.add_argument("--restore", metavar="STREAM", help="append the archived entries to this stream instead of trimming")
+    args = parser.parse_args()
+
+    client = Redis(decode_responses=True)
+    if args.restore:
+        if not args.archive_dir:
+            parser.error("--restore needs --archive-dir")
+        pipe = client.pipeline(transaction=False)
+        restored = 0
+        for stream_id, fields in read_segments(args.archive_dir):
+            pipe.xadd(args.restore, fields, id=stream_id)
+            restored += 1
+            if restored % 1000 == 0:
+                pipe.execute()
+        pipe.execute()
+        print(f"Restored {restored} entries to {args.restore}")
+    else:
+        Retention(client, args.retain, args.archive_dir).maintain(force=True)
@@ -0,0 +1,126 @@
+from datetime import date, datetime, time, timedelta
+
+
+HOUR = 3600
+
+# Hashes of seconds per "total:<classification>" / "app:<name>" field, one per bucket
+HOURLY_KEY = "agg:hourly:{}"  # epoch second the hour starts at
+DAILY_KEY = "agg:daily:{}"  # local calendar date, YYYY-MM-DD
+
+
+def hour_buckets(start, end):
+    """Yields the (bucket, bucket start, bucket end) hours covering [start, end)."""
+    bucket = int(start // HOUR) * HOUR
+    while bucket < end:
+        yield bucket, bucket, bucket + HOUR
+        bucket += HOUR
+
+
+def day_buckets(start, end):
+    """Yields the (date, day start, day end) local days covering [start, end)."""
+    day = datetime.fromtimestamp(start).date()
+    while True:
+        day_start = datetime.combine(day, time()).timestamp()
+        if day_start >= end:
+            return
+        next_day = day + timedelta(days=1)
+        yield day, day_start, datetime.combine(next_day, time()).timestamp()
+        day = next_day
+
+
+def split(start, duration, buckets):
+    """
+    Splits `duration` whole seconds starting at `start` across time buckets.
+
+    Shares are cut at whole seconds from `start`, so they always add up to
+    exactly `duration` no matter how many buckets the interval crosses.
+    """
+    shares = {}
+    if not duration or duration <= 0:
+        return shares
+    end = start + duration
+    for bucket, bucket_start, bucket_end in buckets(start, end):
+        seconds = int(min(end, bucket_end) - start) - int(max(start, bucket_start) - start)
+        if seconds:
+            shares[bucket] = seconds
+    return shares
+
+
+def interval_shares(start, duration):
+    """The seconds of [start, start + duration) per hourly and daily rollup key."""
+    shares = {HOURLY_KEY.format(hour): seconds for hour, seconds in split(start, duration, hour_buckets).items()}
+    for day, seconds in split(start, duration, day_buckets).items():
+        shares[DAILY_KEY.format(day.isoformat())] = seconds
+    return shares
+
+
+def entry_shares(app):
+    """
+    The seconds an app entry contributes per rollup key.
+
+    Entries merged from others that weren't one contiguous block carry the
+    shares of what they replaced, everything else is split from its interval.
+    """
+    if app.get('shares') is not None:
+        return app['shares']
+    return interval_shares(app['start'], app['duration'])
+
+
+def allocate(session):
+    """
+    The seconds a session document contributes to each rollup bucket.
+
+    Returns a dict keyed by (key, field). Unlike the daily totals this includes
+    sessions that are still open, up to the last event seen for them.
+    """
+    shares = {}
+    if not session:
+        return shares
+
+    intervals = [(f"total:{session['classification']}", interval_shares(session['start'], session['duration']))]
+    intervals += [(f"app:{app['name']}", entry_shares(app)) for app in session['apps']]
+    for field, entry in intervals:
+        for key, seconds in entry.items():
+            shares[(key, field)] = shares.get((key, field), 0) + seconds
+    return shares
+
+
+def query(client, start, end, granularity="hour"):
+    """
+    Reads the rollups for [start, end) in a single round trip.
+
+    Args:
+        client (Redis): The Redis client.
+        start (float): Timestamp of the start of the range.
+        end (float): Timestamp of the end of the range.
+        granularity (str): 'hour', 'day' or 'week' (Monday-based, summed from days).
+
+    Returns:
+        list: (bucket start timestamp, {field: seconds}) pairs in time order. Buckets
+        at the edges are returned whole.
+    """
+    if granularity == "hour":
+        buckets = [(bucket, HOURLY_KEY.format(bucket)) for bucket, _, _ in hour_buckets(start, end)]
+    elif granularity in ("day", "week"):
+        buckets = [(day_start, DAILY_KEY.format(day.isoformat())) for day, day_start, _ in day_buckets(start, end)]
+    else:
+        raise ValueError(f"Unknown granularity: {granularity}")
+
+    pipe = client.pipeline(transaction=False)
+    for _, key in buckets:
+        pipe.hgetall(key)
+    results = [
+        (bucket, {field: int(seconds) for field, seconds in values.items()})
+        for (bucket, _), values in zip(buckets, pipe.execute())
+    ]
+    if granularity != "week":
+        return results
+
+    weeks = {}
+    for bucket, values in results:
+        day = date.fromtimestamp(bucket)
+        week = datetime.combine(day - timedelta(days=day.weekday()), time()).timestamp()
+        totals = weeks.setdefault(week, {})
+        for field, seconds in values.items():
+            totals[field] = totals.get(field, 0) + seconds
+    return sorted(weeks.items())
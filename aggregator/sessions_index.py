@@ -0,0 +1,120 @@
+from redis import Redis
+
+# Secondary index of the session documents, so time range lookups don't have to read every session.
+#
+# sessions:by_start scores each session id by its start timestamp, and sessions:by_end by its end
+# timestamp (+inf while it is open). sessions:span holds the longest duration seen, so the
+# sessions overlapping [t0, t1) are found by scanning the ones starting in [t0 - span, t1) and
+# keeping those not ending before t0. The aggregator updates all three in the MULTI that writes the
+# documents; sessions:index_version says the index covers every session, set by the aggregator
+# when it starts without any session, or once the sessions written before are migrated.
+BY_START_KEY = "sessions:by_start"
+BY_END_KEY = "sessions:by_end"
+SPAN_KEY = "sessions:span"
+VERSION_KEY = "sessions:index_version"
+VERSION = 1
+
+
+def index_session(pipe, _id, doc):
+    """Queues the index updates for a session document."""
+    pipe.zadd(BY_START_KEY, {_id: doc['start']})
+    pipe.zadd(BY_END_KEY, {_id: doc['end'] if doc['end'] is not None else float("inf")})
+    # GT keeps the longest span, atomically
+    span = max(doc['duration'], (doc['end'] or doc['start']) - doc['start'])
+    pipe.zadd(SPAN_KEY, {"max": span}, gt=True)
+
+
+def unindex_sessions(pipe, ids):
+    """Queues the removal of session ids from the index."""
+    if ids:
+        pipe.zrem(BY_START_KEY, *ids)
+        pipe.zrem(BY_END_KEY, *ids)
+
+
+def is_indexed(client):
+    return client.get(VERSION_KEY) == str(VERSION)
+
+
+def ending_between(client, start, end):
+    """The ids of the sessions that ended in [start, end)."""
+    return client.zrangebyscore(BY_END_KEY, start, f"({end}")
+
+
+def overlapping(client, start, end, limit=100, cursor=0):
+    """
+    Finds the sessions overlapping [start, end), in start order.
+
+    Args:
+        client (Redis): The Redis client.
+        start (float): Timestamp of the start of the range.
+        end (float): Timestamp of the end of the range.
+        limit (int): The most session ids to return.
+        cursor (int): Where to continue from, as returned by the previous page.
+
+    Returns:
+        tuple: The session ids, and the cursor of the next page or None after the last one.
+    """
+    span = client.zscore(SPAN_KEY, "max") or 0
+    low = start - span
+    # Open sessions may have grown past the span since it was last written, and one left open by a
+    # stalker that never sent its close event stays open forever. The ones starting before the
+    # scanned range are looked up in the open set instead of widening the scan, and come first.
+    older = []
+    open_ids = client.zrangebyscore(BY_END_KEY, "+inf", "+inf")
+    if open_ids:
+        starts = client.zmscore(BY_START_KEY, open_ids)
+        older = [_id for score, _id in sorted(zip(starts, open_ids)) if score is not None and score < low]
+
+    ids = older[cursor:cursor + limit]
+    offset = max(0, cursor - len(older))
+    while len(ids) < limit:
+        page = client.zrangebyscore(BY_START_KEY, low, f"({end}", start=offset, num=limit)
+        if not page:
+            return ids, None
+        for _id, session_end in zip(page, client.zmscore(BY_END_KEY, page)):
+            if len(ids) == limit:
+                return ids, len(older) + offset
+            offset += 1
+            if session_end is None or session_end >= start:
+                ids.append(_id)
+    return ids, len(older) + offset
+
+
+def init(client):
+    """Marks the index as complete when there are no sessions yet, so a new deployment needs no migration."""
+    def mark(pipe):
+        if pipe.exists("sessions"):
+            return
+        pipe.multi()
+        pipe.set(VERSION_KEY, VERSION)
+
+    if not is_indexed(client):
+        client.transaction(mark, "sessions")
+
+
+def migrate(client, chunk=500):
+    """
+    Builds the index from the sessions set.
+
+    Each chunk of documents is watched while it is read and indexed, so the
+    migration can run while the aggregator is live.
+    """
+    ids = sorted(client.smembers("sessions"))
+    for i in range(0, len(ids), chunk):
+        chunk_ids = ids[i:i + chunk]
+        keys = [f"sessions:{_id}" for _id in chunk_ids]
+
+        def index(pipe):
+            docs = pipe.json().mget(keys, ".")
+            pipe.multi()
+            for _id, doc in zip(chunk_ids, docs):
+                if doc:
+                    index_session(pipe, _id, doc)
+
+        client.transaction(index, *keys)
+        print(f"Indexed {min(i + chunk, len(ids))}/{len(ids)} sessions")
+    client.set(VERSION_KEY, VERSION)
+
+
+if __name__ == "__main__":
+    migrate(Redis(decode_responses=True))
@@ -1,23 +1,37 @@
 import os
+import copy
 import warnings
+import torch
 import transformers
 from PIL import Image
 from transformers import (
-    LlavaForConditionalGeneration,
     AutoTokenizer,
     CLIPImageProcessor,
 )
 from processing_llavagemma import LlavaGemmaProcessor
+from inference_backends import get_backend
 
 
 class ActivityClassifier:
-    def __init__(self, checkpoint="Intel/llava-gemma-2b"):
+    def __init__(
+        self,
+        checkpoint="Intel/llava-gemma-2b",
+        max_batch_size=8,
+        scoring=False,
+        prefix_cache=True,
+        backend=None,
+    ):
         """
         Initializes the ActivityClassifier with the specified checkpoint.
         Loads the model and processor.
 
         Args:
             checkpoint (str): The model checkpoint to load.
+            max_batch_size (int): The most screenshots classify_batch puts in one generate call.
+            scoring (bool): Classify by scoring each category in a single forward pass instead of sampling an answer.
+            prefix_cache (bool): Reuse the attention state of the fixed instructions when scoring a single screenshot.
+            backend (str, optional): The inference backend: 'torch', 'torch-int8' or 'openvino'.
+                Defaults to the PRIMETIME_BACKEND environment variable, or 'torch'.
         """
         # Suppress TensorFlow oneDNN warnings
         os.environ["TF_ENABLE_ONEDNN_OPTS"] = "0"
@@ -34,38 +48,39 @@ class ActivityClassifier:
         print(f"Transformers version: {transformers.__version__}")
 
         # Load the model and processor
-        self.model = LlavaForConditionalGeneration.from_pretrained(checkpoint)
+        self.backend = get_backend(backend or os.environ.get("PRIMETIME_BACKEND", "torch"))
+        print(f"Inference backend: {self.backend.name}")
+        self.model = self.backend.load(checkpoint)
         self.processor = LlavaGemmaProcessor(
             tokenizer=AutoTokenizer.from_pretrained(checkpoint),
             image_processor=CLIPImageProcessor.from_pretrained(checkpoint),
         )
 
-        self.model.to("cpu")  # Use CPU instead of CUDA
+        # Batched prompts are padded on the left so generation continues right after each one
+        self.processor.tokenizer.padding_side = "left"
+        self.max_batch_size = max_batch_size
 
         # Define the expected categories
         self.expected_categories = ["Work", "Entertainment", "Social", "Utility"]
 
-    def classify_activity(self, image_path, app_name, win_title):
-        """
-        Classifies the user's activity in the provided image based on the app name.
-
-        Args:
-            image_path (str): The path to the local image file.
-            app_name (str): The name of the application corresponding to the image.
-            win_title (str): The title of the window corresponding to the application.
+        # The first token of each possible answer, compared directly when scoring
+        self.scoring = scoring
+        self.score_categories = self.expected_categories + ["Unclear"]
+        self.category_token_ids = [
+            self.processor.tokenizer.encode(category, add_special_tokens=False)[0]
+            for category in self.score_categories
+        ]
+        if len(set(self.category_token_ids)) != len(self.category_token_ids):
+            raise ValueError("Categories must start with distinct tokens to be scored")
 
-        Returns:
-            str: The classification result ('Work', 'Entertainment', 'Social', 'Utility', or 'Unclear').
-        """
-        # Prepare the prompt with app_name included
-        prompt = self.processor.tokenizer.apply_chat_template(
+        # Split the chat template around the window details, which are the only part that changes
+        marker = "\x00"
+        template = self.processor.tokenizer.apply_chat_template(
             [
                 {
                     "role": "user",
                     "content": (
-                        f"App Name: {app_name}\n"
-                        f"Window Title: {win_title}\n\n"
-                        "Based on the application name, window title, and the provided screenshot, "
+                        "Based on the application name, window title, and the screenshot below, "
                         "determine the user's current activity category. The categories are:\n"
                         "1. 'Work': Tasks related to professional activities such as coding, document editing, data analysis, or using productivity tools.\n"
                         "2. 'Entertainment': Activities like gaming, streaming videos or music, watching movies, or other leisure activities.\n"
@@ -74,13 +89,53 @@ class ActivityClassifier:
                         "Please analyze the screenshot and context carefully to assign the most appropriate category. "
                         "Only select one category that best fits the user's activity. If the activity does not clearly fall into any category, respond with 'Unclear'.\n\n"
                         "Your first sentence should be one word: 'Work', 'Entertainment', 'Social', 'Utility', or 'Unclear'.\n\n"
-                        "<image>"
+                        + marker
                     ),
                 }
             ],
             tokenize=False,
             add_generation_prompt=True,
         )
+        self.prompt_prefix, self.prompt_suffix = template.split(marker)
+
+        # Attention keys/values of the prompt prefix, computed on first use and shared by every call
+        self.prefix_cache = prefix_cache and self.backend.supports_embeddings
+        self.prefix_state = None
+
+    def build_prompt(self, app_name, win_title):
+        """
+        Builds the chat prompt asking the model to classify a window.
+
+        The fixed instructions come first and the window details last, so every prompt
+        starts with the same prompt_prefix.
+
+        Args:
+            app_name (str): The name of the application.
+            win_title (str): The title of the window.
+
+        Returns:
+            str: The prompt, including the <image> placeholder.
+        """
+        return (
+            self.prompt_prefix
+            + f"App Name: {app_name}\n"
+            + f"Window Title: {win_title}\n\n"
+            + "<image>"
+            + self.prompt_suffix
+        )
+
+    def load_image(self, image_path):
+        """
+        Loads a screenshot as an RGB image.
+
+        Args:
+            image_path (str or PIL.Image.Image): The path to the local image file, or an image already in memory.
+
+        Returns:
+            PIL.Image.Image: The loaded image.
+        """
+        if isinstance(image_path, Image.Image):
+            return image_path.convert("RGB")
 
         # Verify that the image exists
         if not os.path.isfile(image_path):
@@ -90,29 +145,20 @@ class ActivityClassifier:
 
         # Load the local image
         try:
-            image = Image.open(image_path).convert("RGB")
+            return Image.open(image_path).convert("RGB")
         except Exception as e:
             raise IOError(f"An error occurred while opening the image: {e}")
 
-        # Process the inputs
-        inputs = self.processor(text=prompt, images=image, return_tensors="pt")
-        inputs = {k: v.to("cpu") for k, v in inputs.items()}
-
-        # Generate the output with max_new_tokens=10 using greedy decoding
-        generate_ids = self.model.generate(
-        **inputs,
-        max_new_tokens=50,
-        do_sample=True,
-        temperature=0.7,
-        num_return_sequences=1,
-    )
-
-        # Decode the output
-        output = self.processor.batch_decode(
-            generate_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False
-        )[0]
-
-        print(output)
+    def parse_classification(self, output):
+        """
+        Finds the category in the decoded model output.
+
+        Args:
+            output (str): The decoded prompt and answer.
+
+        Returns:
+            str: The classification result ('Work', 'Entertainment', 'Social', 'Utility', or 'Unclear').
+        """
         # Split the output into words for iteration
         output_words = output.strip().split()
 
@@ -142,3 +188,182 @@ class ActivityClassifier:
                     break
 
         return classification
+
+    def classify_activity(self, image_path, app_name, win_title):
+        """
+        Classifies the user's activity in the provided image based on the app name.
+
+        Args:
+            image_path (str or PIL.Image.Image): The path to the local image file, or the image itself.
+            app_name (str): The name of the application corresponding to the image.
+            win_title (str): The title of the window corresponding to the application.
+
+        Returns:
+            str: The classification result ('Work', 'Entertainment', 'Social', 'Utility', or 'Unclear').
+        """
+        return self.classify_batch([(image_path, app_name, win_title)])[0]
+
+    def score_activity(self, image_path, app_name, win_title):
+        """
+        Scores each category for the user's activity in a single forward pass.
+
+        Args:
+            image_path (str or PIL.Image.Image): The path to the local image file, or the image itself.
+            app_name (str): The name of the application corresponding to the image.
+            win_title (str): The title of the window corresponding to the application.
+
+        Returns:
+            tuple: The most likely category and a dict of the probability of each category.
+        """
+        if self.prefix_cache:
+            logits = self.score_with_prefix(image_path, app_name, win_title)
+            if logits is not None:
+                return self.pick_category(logits)[0]
+        return self.score_batch([(image_path, app_name, win_title)])[0]
+
+    def get_prefix_state(self):
+        """Runs the prompt prefix through the model once and keeps its token ids and attention state."""
+        if self.prefix_state is None:
+            prefix_ids = self.processor.tokenizer(self.prompt_prefix, return_tensors="pt").input_ids
+            with torch.no_grad():
+                outputs = self.model(input_ids=prefix_ids, use_cache=True)
+            self.prefix_state = (prefix_ids, outputs.past_key_values)
+        return self.prefix_state
+
+    def image_features(self, pixel_values):
+        """Projects an image into the language model's embedding space, as LLaVA does for the <image> token."""
+        config = self.model.config
+        outputs = self.model.vision_tower(pixel_values, output_hidden_states=True)
+        features = outputs.hidden_states[config.vision_feature_layer]
+        if config.vision_feature_select_strategy == "default":
+            features = features[:, 1:]  # Drop the CLS token
+        return self.model.multi_modal_projector(features)
+
+    def score_with_prefix(self, image_path, app_name, win_title):
+        """
+        Computes the next-token logits for one screenshot, only running the model over the
+        part of the prompt after the cached prefix.
+
+        Returns:
+            torch.Tensor: The logits, or None if the prompt doesn't tokenize to the cached prefix.
+        """
+        inputs = self.prepare_batch([(image_path, app_name, win_title)])
+        input_ids = inputs["input_ids"]
+        prefix_ids, past_key_values = self.get_prefix_state()
+        prefix_length = prefix_ids.shape[1]
+        if input_ids.shape[1] <= prefix_length or not torch.equal(input_ids[0, :prefix_length], prefix_ids[0]):
+            return None
+
+        # Embed the suffix ourselves, splicing the image features in place of the <image> token
+        suffix_ids = input_ids[:, prefix_length:]
+        is_image = suffix_ids[0] == self.model.config.image_token_index
+        if int(is_image.sum()) != 1:
+            return None
+        position = int(is_image.nonzero()[0])
+        with torch.no_grad():
+            embeddings = self.model.get_input_embeddings()(suffix_ids.masked_fill(suffix_ids == self.model.config.image_token_index, 0))
+            embeddings = torch.cat(
+                [
+                    embeddings[:, :position],
+                    self.image_features(inputs["pixel_values"]).to(embeddings.dtype),
+                    embeddings[:, position + 1 :],
+                ],
+                dim=1,
+            )
+            attention_mask = torch.ones((1, prefix_length + embeddings.shape[1]), dtype=torch.long)
+            outputs = self.model(
+                inputs_embeds=embeddings,
+                attention_mask=attention_mask,
+                # The cache is extended in place, so every call starts from its own copy
+                past_key_values=copy.deepcopy(past_key_values),
+                use_cache=True,
+            )
+        return outputs.logits[:, -1, :]
+
+    def pick_category(self, logits):
+        """Restricts next-token logits to the categories and returns (classification, scores) per row."""
+        probabilities = torch.softmax(logits[:, self.category_token_ids].float(), dim=-1)
+        results = []
+        for row in probabilities.tolist():
+            scores = dict(zip(self.score_categories, row))
+            results.append((max(scores, key=scores.get), scores))
+        return results
+
+    def prepare_batch(self, batch):
+        """Builds the padded model inputs for (image_path, app_name, win_title) tuples."""
+        prompts = [self.build_prompt(app_name, win_title) for (_, app_name, win_title) in batch]
+        images = [self.load_image(image_path) for (image_path, _, _) in batch]
+
+        # Process the inputs, padding on the left so every prompt ends where the answer starts
+        inputs = self.processor(
+            text=prompts if len(batch) > 1 else prompts[0],
+            images=images if len(batch) > 1 else images[0],
+            padding=len(batch) > 1,
+            return_tensors="pt",
+        )
+        return {k: v.to("cpu") for k, v in inputs.items()}
+
+    def score_batch(self, items, max_batch_size=None):
+        """
+        Scores many screenshots, up to max_batch_size of them per forward pass.
+
+        Only the first token of the answer is computed. Its logits are restricted to the
+        first token of each category and normalized, so the result is deterministic and
+        comes with a confidence.
+
+        Args:
+            items (list): (image_path, app_name, win_title) tuples, where image_path may also be an image.
+            max_batch_size (int, optional): The most screenshots per forward pass. Defaults to the value given at construction.
+
+        Returns:
+            list: (classification, {category: probability}) for each item, in order.
+        """
+        max_batch_size = max_batch_size or self.max_batch_size
+        results = []
+        for start in range(0, len(items), max_batch_size):
+            inputs = self.prepare_batch(items[start : start + max_batch_size])
+
+            with torch.no_grad():
+                logits = self.model(**inputs).logits[:, -1, :]
+            results.extend(self.pick_category(logits))
+
+        return results
+
+    def classify_batch(self, items, max_batch_size=None):
+        """
+        Classifies many screenshots, padding up to max_batch_size of them into each generate call.
+
+        Args:
+            items (list): (image_path, app_name, win_title) tuples, where image_path may also be an image.
+            max_batch_size (int, optional): The most screenshots per generate call. Defaults to the value given at construction.
+
+        Returns:
+            list: The classification result of each item, in order.
+        """
+        if self.scoring:
+            return [classification for (classification, _) in self.score_batch(items, max_batch_size)]
+
+        max_batch_size = max_batch_size or self.max_batch_size
+        classifications = []
+        for start in range(0, len(items), max_batch_size):
+            inputs = self.prepare_batch(items[start : start + max_batch_size])
+
+            # Generate the output with max_new_tokens=50
+            generate_ids = self.model.generate(
+                **inputs,
+                max_new_tokens=50,
+                do_sample=True,
+                temperature=0.7,
+                num_return_sequences=1,
+            )
+
+            # Decode the output
+            outputs = self.processor.batch_decode(
+                generate_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False
+            )
+
+            for output in outputs:
+                print(output)
+                classifications.append(self.parse_classification(output))
+
+        return classifications
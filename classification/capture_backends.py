@@ -0,0 +1,426 @@
+import io
+import os
+import json
+import time
+import random
+import hashlib
+import zlib
+from PIL import Image, ImageDraw
+
+
+class Win32Backend:
+    """The foreground window, its process, idle time and screenshots from the Win32 API."""
+
+    name = "win32"
+
+    def __init__(self, icon_dir, exe_cache_path):
+        # Only importable on Windows, so imported when this backend is selected
+        import ctypes
+        import ctypes.wintypes
+        import win32api
+        import win32con
+        import win32gui
+        import win32process
+        import win32ui
+        import psutil
+        from PIL import ImageGrab
+        from exe_cache import ExeCache
+
+        self.ctypes = ctypes
+        self.win32api = win32api
+        self.win32con = win32con
+        self.win32gui = win32gui
+        self.win32process = win32process
+        self.win32ui = win32ui
+        self.psutil = psutil
+        self.ImageGrab = ImageGrab
+        self.icon_dir = icon_dir
+
+        # Readable names and icons of the executables seen so far, keyed by path and modification time.
+        self.exe_cache = ExeCache(exe_cache_path)
+
+        # Define LASTINPUTINFO structure for tracking idle time
+        class LASTINPUTINFO(ctypes.Structure):
+            _fields_ = [
+                ("cbSize", ctypes.wintypes.UINT),
+                ("dwTime", ctypes.wintypes.DWORD),
+            ]
+
+        self.LASTINPUTINFO = LASTINPUTINFO
+
+        # Make the process DPI-aware
+        ctypes.windll.user32.SetProcessDPIAware()
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def running(self):
+        """Whether there are windows left to track; always, on a real desktop."""
+        return True
+
+    def on_close(self, handler):
+        """Calls handler when the console is closed, or the user logs off or shuts down."""
+
+        def console_handler(event):
+            if event in [
+                self.win32con.CTRL_CLOSE_EVENT,
+                self.win32con.CTRL_LOGOFF_EVENT,
+                self.win32con.CTRL_SHUTDOWN_EVENT,
+            ]:
+                handler()
+                return True  # Signal that event has been handled.
+            return False
+
+        self.win32api.SetConsoleCtrlHandler(console_handler, True)
+
+    def foreground_window(self):
+        """
+        Returns:
+            tuple: The handle (identifier) and title of the currently active window.
+        """
+        hwnd = self.win32gui.GetForegroundWindow()  # Get handle of the active window.
+        win_title = self.win32gui.GetWindowText(hwnd)  # Get the title of the active window.
+        return hwnd, win_title
+
+    def window_process(self, hwnd):
+        """
+        Returns:
+            tuple: The process name and PID of the application owning the window.
+        """
+        _, pid = self.win32process.GetWindowThreadProcessId(hwnd)  # Get the PID of the window.
+        process = self.psutil.Process(pid)  # Use psutil to get process info.
+        return process.name(), pid
+
+    def idle_duration(self):
+        """
+        Returns:
+            float: The seconds since the last keyboard or mouse input.
+        """
+        lastInputInfo = self.LASTINPUTINFO()
+        lastInputInfo.cbSize = self.ctypes.sizeof(self.LASTINPUTINFO)
+        if self.ctypes.windll.user32.GetLastInputInfo(self.ctypes.byref(lastInputInfo)):
+            millis = self.ctypes.windll.kernel32.GetTickCount() - lastInputInfo.dwTime
+            return millis / 1000.0  # Convert milliseconds to seconds
+        else:
+            return 0
+
+    def grab_window(self, hwnd):
+        """
+        Returns:
+            PIL.Image.Image: A full resolution screenshot of the window.
+        """
+        # Get the window coordinates for cropping the screenshot.
+        left, top, right, bottom = self.win32gui.GetWindowRect(hwnd)
+        # Capture the screenshot within the window's bounding box.
+        return self.ImageGrab.grab(bbox=(left, top, right, bottom))
+
+    def app_metadata(self, pid):
+        """
+        Returns the readable name and icon path of the process with pid, only reading the
+        executable the first time it is seen (or after it changed).
+
+        Returns:
+            tuple: The readable name and the icon path, either of which may be None.
+        """
+        return self.exe_cache.get(
+            self.psutil.Process(pid),
+            lambda exe_path: (self.readable_exe_name(exe_path), self.save_icon(exe_path)),
+        )
+
+    # Extracts the application icon of an executable and saves it as a PNG image named after its content,
+    # so each distinct icon is only ever written once.
+    def save_icon(self, exe_path):
+        win32api, win32con, win32gui, win32ui = self.win32api, self.win32con, self.win32gui, self.win32ui
+        try:
+            ico_x = win32api.GetSystemMetrics(win32con.SM_CXICON)  # Standard icon width
+            ico_y = win32api.GetSystemMetrics(win32con.SM_CYICON)  # Standard icon height
+
+            # Extract large and small icons from the executable.
+            large, small = win32gui.ExtractIconEx(exe_path, 0)
+            if small:
+                win32gui.DestroyIcon(small[0])  # Clean up the small icon if it exists.
+
+            # Set up a bitmap and device context for the icon.
+            hdc = win32ui.CreateDCFromHandle(win32gui.GetDC(0))
+            hbmp = win32ui.CreateBitmap()
+            hbmp.CreateCompatibleBitmap(hdc, ico_x, ico_y)
+            hdc = hdc.CreateCompatibleDC()
+
+            # Draw the icon on the bitmap.
+            hdc.SelectObject(hbmp)
+            if large:
+                hdc.DrawIcon((0, 0), large[0])
+                win32gui.DestroyIcon(large[0])
+
+            # Read the bitmap straight into an image instead of going through a temporary file.
+            bits = hbmp.GetBitmapBits(True)
+            hdc.DeleteDC()
+            icon = Image.frombuffer("RGB", (ico_x, ico_y), bits, "raw", "BGRX", 0, 1)
+
+            buffer = io.BytesIO()
+            icon.save(buffer, "PNG")
+            data = buffer.getvalue()
+
+            icon_path = os.path.join(self.icon_dir, f"{hashlib.sha1(data).hexdigest()}.png")
+            if not os.path.exists(icon_path):
+                with open(icon_path, "wb") as f:
+                    f.write(data)
+
+            return icon_path  # Return the path to the saved icon.
+        except Exception as e:
+            print(f"Error saving icon: {e}")
+            return None
+
+    # Retrieves a readable name (e.g., application name) from the executable file path.
+    def readable_exe_name(self, exe_path):
+        ctypes = self.ctypes
+        try:
+            version = (
+                ctypes.windll.version
+            )  # Load the Windows version API for metadata extraction.
+
+            # Get the version info size and allocate a buffer to store this info.
+            size = version.GetFileVersionInfoSizeW(exe_path, None)
+            if size == 0:
+                return os.path.splitext(os.path.basename(exe_path))[0]
+
+            # Load version information into a buffer.
+            res = ctypes.create_string_buffer(size)
+            success = version.GetFileVersionInfoW(exe_path, 0, size, res)
+            if not success:
+                return os.path.splitext(os.path.basename(exe_path))[0]
+
+            # Retrieve the translation info (language and codepage) for the executable.
+            rctypes = ctypes.c_uint
+            lplpBuffer = ctypes.c_void_p()
+            puLen = rctypes(0)
+            success = version.VerQueryValueW(
+                res,
+                "\\VarFileInfo\\Translation",
+                ctypes.byref(lplpBuffer),
+                ctypes.byref(puLen),
+            )
+
+            # Define default language and codepage if not found.
+            languages = [(1033, 1200)] if not success else [(lang, codepage)]
+
+            for lang, codepage in languages:
+                for key in ("FileDescription", "ProductName"):
+                    str_info_path = "\\StringFileInfo\\%04x%04x\\%s" % (lang, codepage, key)
+                    lplpBuffer = ctypes.c_void_p()
+                    puLen = rctypes(0)
+                    success = version.VerQueryValueW(
+                        res, str_info_path, ctypes.byref(lplpBuffer), ctypes.byref(puLen)
+                    )
+                    if success and puLen.value > 0:
+                        value = ctypes.wstring_at(lplpBuffer, puLen.value)
+                        clean_value = value.replace("\x00", "").strip()
+                        if clean_value:
+                            return clean_value  # Return the clean readable name if found.
+
+            # Fallback to the file name if description not found.
+            return os.path.splitext(os.path.basename(exe_path))[0]
+        except Exception as e:
+            print(f"Error retrieving name: {e}")
+            return os.path.splitext(os.path.basename(exe_path))[0]
+
+
+# Windows the generated traces switch between, covered by the default rules so the vision model isn't needed.
+SYNTHETIC_WINDOWS = [
+    ("Code.exe", "Visual Studio Code", ["main.py - PrimeTime", "stalker.py - PrimeTime", "README.md - notes"]),
+    ("firefox.exe", "Firefox", ["GitHub - Pull requests", "YouTube - Home", "Reddit - r/python", "Stack Overflow"]),
+    ("Discord.exe", "Discord", ["#general | PrimeTime", "Friends"]),
+    ("olk.exe", "Outlook", ["Inbox - Outlook", "Calendar - Outlook"]),
+    ("explorer.exe", "Windows Explorer", ["Downloads", "Documents"]),
+]
+
+
+def generate_trace(switches, mean_dwell=30.0, min_dwell=1.0, idle_rate=0.02, seed=0):
+    """
+    Generates a window switch trace.
+
+    Args:
+        switches (int): The number of window switches.
+        mean_dwell (float): The mean seconds spent in a window, exponentially distributed.
+        min_dwell (float): The fewest seconds spent in a window; keep it above the polling interval.
+        idle_rate (float): The fraction of switches that happen after the user was idle.
+        seed (int): The random seed, so a trace can be generated again.
+
+    Returns:
+        list: The trace entries, see ReplayBackend.
+    """
+    rng = random.Random(seed)
+    trace = []
+    at = 0.0
+    hwnd = None
+    for _ in range(switches):
+        process, app_name, titles = rng.choice(SYNTHETIC_WINDOWS)
+        title = rng.choice(titles)
+        # A switch always goes to another window, like the stalker would see it
+        previous = hwnd
+        hwnd = zlib.crc32(f"{process}|{title}".encode()) or 1
+        if hwnd == previous:
+            continue
+        dwell = max(min_dwell, rng.expovariate(1 / mean_dwell))
+        trace.append(
+            {
+                "at": round(at, 3),
+                "hwnd": hwnd,
+                "title": title,
+                "process": process,
+                "pid": zlib.crc32(process.encode()) % 60000 + 1000,
+                "app_name": app_name,
+                "idle": 600 if rng.random() < idle_rate else 0,
+                "duration": round(dwell, 3),
+            }
+        )
+        at += dwell
+    return trace
+
+
+def load_trace(path):
+    """Reads a trace written by RecordingBackend, one JSON entry per line."""
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class ReplayBackend:
+    """
+    Replays a window switch trace on a virtual clock, so the whole pipeline runs anywhere.
+
+    Each trace entry has "at" (seconds from the start of the trace), "hwnd", "title",
+    "process", "pid" and "app_name", and optionally "icon", "idle" (the idle seconds
+    reported while it has focus) and "duration" (how long it keeps focus if it is last).
+    """
+
+    name = "replay"
+
+    def __init__(self, trace=None, speed=0, switches=1000, seed=0, screenshots=True):
+        """
+        Args:
+            trace (str): A recorded trace file; a trace of switches is generated if None.
+            speed (float): How much faster than real time to replay, 0 to replay as fast as possible.
+            switches (int): The number of switches of the generated trace.
+            seed (int): The random seed of the generated trace.
+            screenshots (bool): Whether to draw a screenshot for each window.
+        """
+        self.trace = load_trace(trace) if trace else generate_trace(switches, seed=seed)
+        self.speed = speed
+        self.screenshots = screenshots
+        self.frames = {}  # hwnd -> its drawn screenshot
+        self.position = -1
+        # Virtual timestamps start now, so the events look like a live session to the aggregator
+        self.start = time.time()
+        self.clock = self.start
+        last = self.trace[-1] if self.trace else {"at": 0}
+        self.end = last["at"] + last.get("duration", 0)
+
+    def time(self):
+        return self.clock
+
+    def sleep(self, seconds):
+        self.clock += seconds
+        if self.speed:
+            time.sleep(seconds / self.speed)
+
+    def running(self):
+        return self.clock - self.start <= self.end
+
+    def on_close(self, handler):
+        pass
+
+    def current(self):
+        elapsed = self.clock - self.start
+        while self.position + 1 < len(self.trace) and self.trace[self.position + 1]["at"] <= elapsed:
+            self.position += 1
+        return self.trace[self.position] if self.position >= 0 else None
+
+    def foreground_window(self):
+        entry = self.current()
+        if entry is None:
+            return 0, ""
+        return entry["hwnd"], entry["title"]
+
+    def window_process(self, hwnd):
+        entry = self.current()
+        return entry["process"], entry["pid"]
+
+    def idle_duration(self):
+        entry = self.current()
+        return entry.get("idle", 0) if entry else 0
+
+    def grab_window(self, hwnd):
+        if not self.screenshots:
+            return None
+        if hwnd not in self.frames:
+            entry = self.current()
+            # A flat color per window with its title on it, so unchanged windows hash the same.
+            # Drawn once at the classifier's input size, so replaying measures the pipeline rather than the drawing.
+            color = zlib.crc32(str(hwnd).encode()) & 0xFFFFFF
+            image = Image.new("RGB", (598, 336), ((color >> 16) & 255, (color >> 8) & 255, color & 255))
+            ImageDraw.Draw(image).text((16, 16), entry["title"] if entry else "", fill=(255, 255, 255))
+            self.frames[hwnd] = image
+        return self.frames[hwnd]
+
+    def app_metadata(self, pid):
+        entry = self.current()
+        return entry["app_name"], entry.get("icon")
+
+
+class RecordingBackend:
+    """Wraps another backend and appends every window switch it reports to a trace file."""
+
+    def __init__(self, backend, path):
+        self.backend = backend
+        self.name = backend.name
+        self.path = path
+        self.start = backend.time()
+        self.last = None
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def foreground_window(self):
+        hwnd, win_title = self.backend.foreground_window()
+        if hwnd and (hwnd, win_title) != self.last:
+            self.last = (hwnd, win_title)
+            try:
+                process, pid = self.backend.window_process(hwnd)
+                app_name, icon = self.backend.app_metadata(pid)
+                entry = {
+                    "at": round(self.backend.time() - self.start, 3),
+                    "hwnd": hwnd,
+                    "title": win_title,
+                    "process": process,
+                    "pid": pid,
+                    "app_name": app_name or process,
+                    "icon": icon,
+                    "idle": self.backend.idle_duration(),
+                }
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(entry) + "\n")
+            except Exception as e:
+                print(f"Error recording window switch: {e}")
+        return hwnd, win_title
+
+
+BACKENDS = {backend.name: backend for backend in (Win32Backend, ReplayBackend)}
+
+
+def get_backend(name, **kwargs):
+    """
+    Looks up a capture backend by name.
+
+    Args:
+        name (str): 'win32' or 'replay'.
+        **kwargs: Passed on to the backend.
+
+    Returns:
+        An instance of the backend.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown capture backend '{name}', expected one of: {', '.join(BACKENDS)}")
+    return BACKENDS[name](**kwargs)
@@ -0,0 +1,201 @@
+import os
+import re
+import json
+import math
+import time
+import fnmatch
+import threading
+
+
+class RuleTable:
+    def __init__(self, path, check_interval=5.0):
+        """
+        Initializes the user-editable rule table.
+
+        Each rule in the JSON file has an "app" glob matched against the executable or
+        readable app name, an optional "title" regex searched in the window title, and
+        the "classification" to use. The first matching rule wins.
+
+        Args:
+            path (str): The JSON file holding the rules.
+            check_interval (float): The seconds between two checks of whether the file was edited.
+        """
+        self.path = path
+        self.check_interval = check_interval
+        self.rules = []
+        self.mtime = None
+        self.checked = 0
+        self.reload()
+
+    def reload(self):
+        """Reloads the rules if the file was edited since they were last read."""
+        self.checked = time.time()
+        try:
+            mtime = os.path.getmtime(self.path)
+            if mtime == self.mtime:
+                return
+            with open(self.path, "r") as f:
+                rules = json.load(f)
+            self.rules = [
+                (
+                    rule["app"].lower(),
+                    re.compile(rule["title"], re.IGNORECASE) if rule.get("title") else None,
+                    rule["classification"],
+                )
+                for rule in rules
+            ]
+            self.mtime = mtime
+        except FileNotFoundError:
+            self.rules = []
+        except Exception as e:
+            print(f"Error loading classification rules: {e}")
+
+    def match(self, exe_name, app_name, win_title):
+        """
+        Returns:
+            str: The classification of the first matching rule, or None.
+        """
+        # Edits are picked up within check_interval, without touching the file on every switch
+        if time.time() - self.checked >= self.check_interval:
+            self.reload()
+        names = [(exe_name or "").lower(), (app_name or "").lower()]
+        for app, title, classification in self.rules:
+            if any(fnmatch.fnmatchcase(name, app) for name in names) and (
+                title is None or title.search(win_title or "")
+            ):
+                return classification
+        return None
+
+
+class TextClassifier:
+    def __init__(self, path, threshold=0.9, min_examples=20):
+        """
+        Initializes a naive Bayes classifier over the words of the app name and window title.
+
+        It learns from the answers of the vision model, and only answers once it has seen
+        enough of them and is confident.
+
+        Args:
+            path (str): The JSON file the word counts are persisted to.
+            threshold (float): The probability the best category needs for the answer to be used.
+            min_examples (int): The number of examples to learn from before answering at all.
+        """
+        self.path = path
+        self.threshold = threshold
+        self.min_examples = min_examples
+        self.class_counts = {}  # classification -> number of examples
+        self.token_counts = {}  # classification -> {token: count}
+        # The worker thread learns while the polling thread predicts
+        self.lock = threading.Lock()
+        self.load()
+
+    @staticmethod
+    def tokens(exe_name, app_name, win_title):
+        words = re.findall(r"[a-z0-9]+", f"{app_name or ''} {win_title or ''}".lower())
+        # The executable alone is a strong signal, keep it as one token
+        return [f"exe:{(exe_name or '').lower()}"] + words
+
+    def predict(self, exe_name, app_name, win_title):
+        """
+        Returns:
+            tuple: The most likely classification and its probability, or (None, 0.0) before any examples.
+        """
+        tokens = self.tokens(exe_name, app_name, win_title)
+        scores = {}
+        with self.lock:
+            total = sum(self.class_counts.values())
+            if not total:
+                return None, 0.0
+
+            vocabulary = len({token for counts in self.token_counts.values() for token in counts}) or 1
+            for classification, examples in self.class_counts.items():
+                counts = self.token_counts[classification]
+                words = sum(counts.values())
+                scores[classification] = math.log(examples / total) + sum(
+                    math.log((counts.get(token, 0) + 1) / (words + vocabulary)) for token in tokens
+                )
+
+        best = max(scores, key=scores.get)
+        probability = 1 / sum(math.exp(score - scores[best]) for score in scores.values())
+        return best, probability
+
+    def classify(self, exe_name, app_name, win_title):
+        """
+        Returns:
+            str: The classification if the classifier is confident, otherwise None.
+        """
+        with self.lock:
+            examples = sum(self.class_counts.values())
+        if examples < self.min_examples:
+            return None
+        classification, probability = self.predict(exe_name, app_name, win_title)
+        return classification if probability >= self.threshold else None
+
+    def learn(self, exe_name, app_name, win_title, classification):
+        """Adds an example and persists the counts."""
+        with self.lock:
+            self.class_counts[classification] = self.class_counts.get(classification, 0) + 1
+            counts = self.token_counts.setdefault(classification, {})
+            for token in self.tokens(exe_name, app_name, win_title):
+                counts[token] = counts.get(token, 0) + 1
+            self.save()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            self.class_counts = data["class_counts"]
+            self.token_counts = data["token_counts"]
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Error loading text classifier: {e}")
+
+    def save(self):
+        """Persists the counts, with the lock held."""
+        try:
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, "w") as f:
+                json.dump({"class_counts": self.class_counts, "token_counts": self.token_counts}, f)
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            print(f"Error saving text classifier: {e}")
+
+
+class CascadeClassifier:
+    def __init__(self, rules, text):
+        """
+        Initializes the cheap tiers that run before the vision model.
+
+        Args:
+            rules (RuleTable): The first tier, user-editable rules.
+            text (TextClassifier): The second tier, a classifier over the app name and title.
+        """
+        self.rules = rules
+        self.text = text
+        self.tiers = {}  # tier -> number of classifications it answered
+
+    def classify(self, exe_name, app_name, win_title):
+        """
+        Classifies a window from its names alone.
+
+        Returns:
+            tuple: The classification and the tier that answered ('rules' or 'text'), or
+            (None, None) when the vision model is needed.
+        """
+        classification = self.rules.match(exe_name, app_name, win_title)
+        if classification:
+            return classification, "rules"
+
+        classification = self.text.classify(exe_name, app_name, win_title)
+        if classification:
+            return classification, "text"
+        return None, None
+
+    def record(self, tier):
+        """Counts a classification by the tier that answered it."""
+        self.tiers[tier] = self.tiers.get(tier, 0) + 1
+
+    def stats(self):
+        total = sum(self.tiers.values())
+        return {tier: f"{count} ({count / total:.0%})" for tier, count in self.tiers.items()}
@@ -0,0 +1,108 @@
+import os
+import re
+import json
+import time
+import threading
+from collections import OrderedDict
+
+
+class ClassificationCache:
+    def __init__(self, path, max_entries=512, ttl=7 * 24 * 3600):
+        """
+        Initializes a bounded, persistent cache of classifications keyed by window.
+
+        Args:
+            path (str): The JSON file the cache is persisted to.
+            max_entries (int): The maximum number of windows kept; the least recently used are evicted first.
+            ttl (int): How long a classification stays valid, in seconds.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> [classification, time it was classified]
+        self.hits = 0
+        self.misses = 0
+        # The worker thread stores results while the polling thread looks them up
+        self.lock = threading.Lock()
+        self.load()
+
+    @staticmethod
+    def normalize(app_name, win_title):
+        """
+        Builds the cache key for a window.
+
+        Unread counters such as "(3) " and unsaved-change markers are dropped so the
+        same window keeps the same key while its title ticks over.
+        """
+        title = (win_title or "").lower()
+        title = re.sub(r"^\(\d+\+?\)\s*", "", title)  # "(3) Discord"
+        title = title.replace("●", "").lstrip("* ")  # "● main.py - Visual Studio Code"
+        title = " ".join(title.split())
+        return f"{(app_name or '').lower().strip()}\n{title}"
+
+    def get(self, app_name, win_title):
+        """
+        Looks up the classification of a window.
+
+        Returns:
+            str: The cached classification, or None on a miss.
+        """
+        key = self.normalize(app_name, win_title)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and time.time() - entry[1] < self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            if entry:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, app_name, win_title, classification):
+        """Stores the classification of a window and persists the cache."""
+        key = self.normalize(app_name, win_title)
+        with self.lock:
+            self.entries[key] = [classification, time.time()]
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.save()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self.entries),
+        }
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            print(f"Error loading classification cache: {e}")
+            return
+
+        now = time.time()
+        for key, entry in entries:
+            if now - entry[1] < self.ttl:
+                self.entries[key] = entry
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def save(self):
+        """Persists the cache, with the lock held."""
+        try:
+            # Write to a temporary file first so a crash never leaves a truncated cache.
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, "w") as f:
+                json.dump(list(self.entries.items()), f)
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            print(f"Error saving classification cache: {e}")
@@ -0,0 +1,53 @@
+import queue
+import threading
+import traceback
+
+
+class ClassificationWorker(threading.Thread):
+    def __init__(self, classify, is_needed, on_done, max_jobs=4):
+        """
+        Initializes a background thread that runs classifications off the polling loop.
+
+        Args:
+            classify (callable): Takes a job and returns its classification, or None if it turned out stale. This is the slow model call.
+            is_needed (callable): Takes a job and returns whether its result is still needed.
+            on_done (callable): Called with the job and its classification, or None if the job was dropped.
+            max_jobs (int): The maximum number of jobs waiting; the oldest is dropped when a new one arrives.
+        """
+        super().__init__(daemon=True, name="ClassificationWorker")
+        self.classify = classify
+        self.is_needed = is_needed
+        self.on_done = on_done
+        self.jobs = queue.Queue(maxsize=max_jobs)
+
+    def submit(self, job):
+        """Queues a job without ever blocking the caller."""
+        while True:
+            try:
+                self.jobs.put_nowait(job)
+                return
+            except queue.Full:
+                try:
+                    self.drop(self.jobs.get_nowait())
+                except queue.Empty:
+                    pass
+
+    def drop(self, job):
+        print(f"Dropping classification of {job['app_name']}: {job['win_title']}")
+        self.on_done(job, None)
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            # The window lost focus while the job was waiting, nobody needs the result anymore.
+            if not self.is_needed(job):
+                self.drop(job)
+                continue
+
+            try:
+                classification = self.classify(job)
+            except Exception as e:
+                print(f"Error classifying activity: {e}")
+                traceback.print_exc()
+                classification = "Unclear"
+            self.on_done(job, classification)
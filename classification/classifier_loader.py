@@ -0,0 +1,43 @@
+import threading
+import traceback
+
+
+class ClassifierLoader(threading.Thread):
+    def __init__(self, **kwargs):
+        """
+        Initializes a background thread that imports and loads the ActivityClassifier.
+
+        Importing transformers and loading the checkpoint takes a long time, so the
+        stalker starts tracking windows right away and only waits for the model when
+        it actually has to run it.
+
+        Args:
+            **kwargs: Passed on to ActivityClassifier.
+        """
+        super().__init__(daemon=True, name="ClassifierLoader")
+        self.kwargs = kwargs
+        self.classifier = None
+        self.ready = threading.Event()  # Set once loading finished, whether or not it succeeded
+
+    def run(self):
+        try:
+            # Imported here so the heavy dependencies never load on the caller's thread
+            from activity_classifier import ActivityClassifier
+
+            self.classifier = ActivityClassifier(**self.kwargs)
+            print("Classifier ready.")
+        except Exception as e:
+            print(f"Error loading classifier: {e}")
+            traceback.print_exc()
+        finally:
+            self.ready.set()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the classifier is loaded.
+
+        Returns:
+            ActivityClassifier: The classifier, or None if loading failed or timed out.
+        """
+        self.ready.wait(timeout)
+        return self.classifier
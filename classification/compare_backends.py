@@ -0,0 +1,161 @@
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import psutil
+from PIL import Image, ImageDraw
+from activity_classifier import ActivityClassifier
+from inference_backends import BACKENDS
+
+# Checks that the inference backends agree with each other on a fixed set of screenshots,
+# and reports how much memory and time each of them needs.
+#
+#   python compare_backends.py --backends torch torch-int8 openvino
+#
+# The sample directory holds the screenshots, plus an optional samples.json mapping each
+# file name to its {"app_name": ..., "win_title": ...}. samples/ next to this script is the
+# fixed set the backends are compared on: mockups of common windows drawn by make_samples(),
+# committed so every run sees the same pixels; --make-samples draws them again.
+#
+# Each backend runs in its own freshly spawned process, so its memory is measured from a clean
+# baseline rather than after the previous backends were loaded and freed in the same process.
+
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "samples")
+
+# file name, app name, window title, background, text color, body lines
+SAMPLE_WINDOWS = [
+    ("code.png", "Code.exe", "main.py - primetime - Visual Studio Code", "#1e1e1e", "#d4d4d4",
+     ["def flush(self):", "    deltas = {}", "    for _id in self.dirty:", "        record = self.sessions[_id]", "    return deltas"]),
+    ("docs.png", "firefox.exe", "collections - Python 3 documentation - Mozilla Firefox", "#ffffff", "#222222",
+     ["collections - Container datatypes", "", "OrderedDict: dict subclass that remembers the order entries were added",
+      "move_to_end(key, last=True)", "popitem(last=True)"]),
+    ("video.png", "firefox.exe", "Funny cats compilation 2024 - YouTube - Mozilla Firefox", "#0f0f0f", "#f1f1f1",
+     ["", "", "", "Funny cats compilation 2024", "1.2M views  -  Like  Share"]),
+    ("chat.png", "Discord.exe", "#general | Friends - Discord", "#313338", "#dbdee1",
+     ["alex: anyone up for a game tonight?", "sam: sure, 9pm?", "alex: see you then", "kim: sent the memes"]),
+    ("files.png", "explorer.exe", "Downloads - File Explorer", "#ffffff", "#1b1b1b",
+     ["Name                         Date modified      Size", "setup.exe                    10/17/2026         54 MB",
+      "report.pdf                   10/16/2026        820 KB", "photos.zip                   10/12/2026        1.3 GB"]),
+    ("mail.png", "olk.exe", "Inbox - Outlook", "#f5f5f5", "#242424",
+     ["Focused   Other", "Team standup notes - Today's action items", "Invoice #4821 - Payment received",
+      "Weekend sale - 40% off everything"]),
+    ("docker.png", "Docker Desktop.exe", "Containers - Docker Desktop", "#f4f4f6", "#0b214a",
+     ["Containers", "redis-stack     redis/redis-stack:latest     Running     6379:6379", "aggregator      primetime:dev                Exited"]),
+    ("terminal.png", "WindowsTerminal.exe", "Windows PowerShell", "#0c0c0c", "#cccccc",
+     ["PS C:\\primetime> python aggregator\\main.py --retain 86400", "Recovered 12 sessions", "itm: 100/100 events up to 1792307310490-4"]),
+]
+
+
+def make_samples(sample_dir, icon_dir=os.path.join(os.path.dirname(os.path.abspath(__file__)), "icons")):
+    """Draws the fixed sample screenshots and their samples.json manifest into sample_dir."""
+    os.makedirs(sample_dir, exist_ok=True)
+    manifest = {}
+    for name, app_name, win_title, background, color, lines in SAMPLE_WINDOWS:
+        image = Image.new("RGB", (800, 500), background)
+        draw = ImageDraw.Draw(image)
+        draw.rectangle((0, 0, 800, 32), fill="#dddddd")
+        icon_path = os.path.join(icon_dir, f"{app_name}.png")
+        if os.path.isfile(icon_path):
+            with Image.open(icon_path) as icon:
+                icon = icon.convert("RGBA").resize((24, 24))
+                image.paste(icon, (6, 4), icon)
+        draw.text((38, 10), win_title, fill="#000000")
+        if name == "video.png":
+            draw.rectangle((40, 50, 760, 400), fill="#3a3a3a")
+            draw.polygon([(370, 180), (370, 270), (450, 225)], fill="#ffffff")
+        for i, line in enumerate(lines):
+            draw.text((40, 60 + i * 28 if name != "video.png" else 330 + i * 28), line, fill=color)
+        image.save(os.path.join(sample_dir, name))
+        manifest[name] = {"app_name": app_name, "win_title": win_title}
+    with open(os.path.join(sample_dir, "samples.json"), "w") as f:
+        json.dump(manifest, f, indent=4)
+
+
+def load_samples(sample_dir):
+    manifest = {}
+    manifest_path = os.path.join(sample_dir, "samples.json")
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+
+    samples = []
+    for name in sorted(os.listdir(sample_dir)):
+        if os.path.splitext(name)[1].lower() in (".png", ".jpg", ".jpeg", ".webp"):
+            details = manifest.get(name, {})
+            samples.append(
+                (
+                    os.path.join(sample_dir, name),
+                    details.get("app_name", ""),
+                    details.get("win_title", ""),
+                )
+            )
+    return samples
+
+
+def run_backend(name, samples):
+    """Runs one backend over the samples, in the process it is called in."""
+    process = psutil.Process()
+    memory = process.memory_info().rss
+
+    classifier = ActivityClassifier(backend=name, scoring=True)
+    memory = process.memory_info().rss - memory
+
+    results = []
+    start = time.time()
+    for sample in samples:
+        results.append(classifier.score_activity(*sample))
+    latency = (time.time() - start) / max(len(samples), 1)
+    return results, memory, latency
+
+
+def run_isolated(name, samples):
+    """Runs one backend over the samples in a freshly spawned process of its own."""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(run_backend, name, samples).result()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare inference backends on sample screenshots.")
+    parser.add_argument("sample_dir", nargs="?", default=SAMPLE_DIR)
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=list(BACKENDS))
+    parser.add_argument("--min-agreement", type=float, default=0.9)
+    parser.add_argument("--make-samples", action="store_true", help="draw the fixed sample screenshots into sample_dir and exit")
+    args = parser.parse_args()
+
+    if args.make_samples:
+        make_samples(args.sample_dir)
+        sys.exit(0)
+
+    samples = load_samples(args.sample_dir)
+    if not samples:
+        sys.exit(f"No screenshots found in {args.sample_dir}")
+
+    runs = {}
+    for name in args.backends:
+        try:
+            runs[name] = run_isolated(name, samples)
+        except Exception as e:
+            print(f"Error running backend {name}: {e}")
+
+    if not runs:
+        sys.exit("No backend could be run")
+
+    # The first backend that ran is the reference the others are checked against
+    reference = next(iter(runs))
+    failed = False
+    for name, (results, memory, latency) in runs.items():
+        agreement = sum(
+            result[0] == expected[0] for result, expected in zip(results, runs[reference][0])
+        ) / len(samples)
+        print(
+            f"{name:>12}: agreement with {reference} {agreement:.0%}, "
+            f"model memory {memory / 2 ** 20:.0f} MiB, {latency:.2f}s per screenshot"
+        )
+        for (path, _, _), (classification, scores) in zip(samples, results):
+            print(f"{'':>14}{os.path.basename(path)}: {classification} ({scores[classification]:.2f})")
+        failed = failed or agreement < args.min_agreement
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,99 @@
+import json
+import time
+
+# Version 2 of the activity stream entries: the event as native stream fields instead of a JSON
+# blob, with the repeated strings (classification, app name, icon, tier, screenshot directory)
+# replaced by small ids interned in the events:strings hash.
+#
+#   v  format version, 2
+#   i  session id
+#   t  timestamp, in seconds
+#   s  1 when the window is opened or updated, 0 when it is closed, 2 when a closed window is reclassified
+#   c  classification id       a  app name id       w  window title
+#   k  icon path id            d  screenshot directory id, p  screenshot file name
+#   r  tier id                 u  1 if deduplicated q  model confidence
+#
+# Every entry has the same fields in the same order, with "" for missing values, so Redis stores the
+# field names once per stream node instead of once per entry. The aggregator also still reads
+# version 1 entries, {"data": json.dumps(event)}.
+VERSION = 2
+FIELDS = ("v", "i", "t", "s", "c", "a", "w", "k", "d", "p", "r", "u", "q")
+STRINGS_KEY = "events:strings"  # id -> string
+STRING_IDS_KEY = "events:string_ids"  # string -> id
+STRING_SEQ_KEY = "events:string_seq"
+# The oldest entry the aggregators still need, published by them; older entries are trimmed as events are added
+TRIM_ID_KEY = "agg:trim_id"
+TRIM_CHECK_INTERVAL = 60  # Seconds between two reads of the trim id
+
+
+class EventEncoder:
+    def __init__(self, client, legacy=False):
+        """
+        Initializes the writer of events to the activity stream.
+
+        Args:
+            client (Redis): The Redis client.
+            legacy (bool): Whether to keep writing version 1 JSON entries, for aggregators not updated yet.
+        """
+        self.client = client
+        self.legacy = legacy
+        self.ids = {}  # string -> id, only ever grows
+        self.trim_id = None
+        self.trim_checked = 0
+
+    def intern(self, value):
+        """
+        Returns:
+            int | str: The id of a string, allocated the first time it is seen, or "" for None.
+        """
+        if value is None:
+            return ""
+        value = str(value)
+        if value in self.ids:
+            return self.ids[value]
+
+        _id = self.client.hget(STRING_IDS_KEY, value)
+        if _id is None:
+            _id = self.client.incr(STRING_SEQ_KEY)
+            # The string goes in first, so a reader never sees an id it can't resolve
+            self.client.hset(STRINGS_KEY, _id, value)
+            if not self.client.hsetnx(STRING_IDS_KEY, value, _id):
+                # Another stalker interned it at the same time, use its id
+                _id = self.client.hget(STRING_IDS_KEY, value)
+        self.ids[value] = int(_id)
+        return self.ids[value]
+
+    def encode(self, event):
+        """
+        Returns:
+            dict: The stream fields of an event.
+        """
+        if self.legacy:
+            return {"data": json.dumps(event)}
+
+        screenshot = event.get("screenshot") or ""
+        cut = max(screenshot.rfind("/"), screenshot.rfind("\\")) + 1
+        confidence = event.get("confidence")
+        values = (
+            VERSION,
+            event["id"],
+            repr(float(event["timestamp"])),
+            2 if event.get("reclassify") else int(bool(event["state"])),
+            self.intern(event.get("classification")),
+            self.intern(event.get("app_name")),
+            event.get("win_title") or "",
+            self.intern(event.get("icon")),
+            self.intern(screenshot[:cut] if screenshot else None),
+            screenshot[cut:],
+            self.intern(event.get("tier")),
+            int(bool(event.get("deduplicated"))),
+            "" if confidence is None else repr(float(confidence)),
+        )
+        return dict(zip(FIELDS, values))
+
+    def send(self, event):
+        """Appends an event to the activity stream, trimming the entries every aggregator is done with."""
+        if time.time() - self.trim_checked >= TRIM_CHECK_INTERVAL:
+            self.trim_checked = time.time()
+            self.trim_id = self.client.get(TRIM_ID_KEY)
+        self.client.xadd("activity", self.encode(event), minid=self.trim_id, approximate=True)
@@ -0,0 +1,82 @@
+import os
+import json
+from collections import OrderedDict
+
+
+class ExeCache:
+    def __init__(self, path, max_processes=256):
+        """
+        Initializes the persistent cache of executable metadata (readable name and icon).
+
+        Both are pure functions of the executable, so entries are keyed by its path and
+        only recomputed when its modification time changes.
+
+        Args:
+            path (str): The JSON file the cache is persisted to.
+            max_processes (int): The maximum number of processes remembered; the least recently used are evicted first.
+        """
+        self.path = path
+        self.max_processes = max_processes
+        self.entries = {}  # exe path -> {"mtime": ..., "name": ..., "icon": ...}
+        self.processes = OrderedDict()  # (pid, create time) -> exe path, validated once per process
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def get(self, process, compute):
+        """
+        Returns the readable name and icon path of a process's executable.
+
+        A process that was already looked up is answered from memory without touching
+        the disk; a running executable can't be replaced under its process.
+
+        Args:
+            process (psutil.Process): The process.
+            compute (callable): Takes the exe path and returns (name, icon path), called on a miss.
+
+        Returns:
+            tuple: The readable name and the icon path.
+        """
+        key = (process.pid, process.create_time())
+        exe_path = self.processes.get(key)
+        if exe_path in self.entries:
+            self.processes.move_to_end(key)
+            self.hits += 1
+            entry = self.entries[exe_path]
+            return entry["name"], entry["icon"]
+
+        exe_path = process.exe()
+        mtime = os.path.getmtime(exe_path)
+        entry = self.entries.get(exe_path)
+        # An executable without an icon is cached as such, an icon file deleted since is extracted again
+        if entry and entry["mtime"] == mtime and (entry["icon"] is None or os.path.exists(entry["icon"])):
+            self.hits += 1
+        else:
+            self.misses += 1
+            name, icon_path = compute(exe_path)
+            entry = {"mtime": mtime, "name": name, "icon": icon_path}
+            self.entries[exe_path] = entry
+            self.save()
+
+        self.processes[key] = exe_path
+        while len(self.processes) > self.max_processes:
+            self.processes.popitem(last=False)
+        return entry["name"], entry["icon"]
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Error loading executable cache: {e}")
+
+    def save(self):
+        try:
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            print(f"Error saving executable cache: {e}")
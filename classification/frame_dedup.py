@@ -0,0 +1,69 @@
+from PIL import Image
+
+
+class FrameDeduplicator:
+    def __init__(self, max_distance=6, hash_size=8):
+        """
+        Initializes the deduplicator that skips inference for frames that barely changed.
+
+        Args:
+            max_distance (int): The largest Hamming distance between two frame hashes that still counts as the same frame.
+            hash_size (int): The width and height of the difference hash, giving hash_size ** 2 bits.
+        """
+        self.max_distance = max_distance
+        self.hash_size = hash_size
+        self.frames = {}  # window -> (hash of the last classified frame, its classification)
+        self.checked = 0
+        self.deduplicated = 0
+
+    def frame_hash(self, image):
+        """
+        Computes the difference hash (dHash) of a frame.
+
+        Args:
+            image (PIL.Image.Image or str): The frame, or the path to it.
+
+        Returns:
+            int: A hash_size ** 2 bit fingerprint; similar frames differ in few bits.
+        """
+        if isinstance(image, str):
+            with Image.open(image) as f:
+                return self.frame_hash(f.convert("L"))
+
+        pixels = list(
+            image.convert("L")
+            .resize((self.hash_size + 1, self.hash_size), Image.BILINEAR)
+            .getdata()
+        )
+        value = 0
+        for row in range(self.hash_size):
+            for col in range(self.hash_size):
+                left = pixels[row * (self.hash_size + 1) + col]
+                right = pixels[row * (self.hash_size + 1) + col + 1]
+                value = (value << 1) | (left > right)
+        return value
+
+    def match(self, window, frame_hash):
+        """
+        Looks up the classification of the last frame classified for a window.
+
+        Returns:
+            str: The previous classification if the frame is within max_distance of it, otherwise None.
+        """
+        self.checked += 1
+        previous = self.frames.get(window)
+        if previous and bin(previous[0] ^ frame_hash).count("1") <= self.max_distance:
+            self.deduplicated += 1
+            return previous[1]
+        return None
+
+    def remember(self, window, frame_hash, classification):
+        """Records the frame a window was last classified from."""
+        self.frames[window] = (frame_hash, classification)
+
+    def stats(self):
+        return {
+            "checked": self.checked,
+            "deduplicated": self.deduplicated,
+            "dedup_rate": self.deduplicated / self.checked if self.checked else 0.0,
+        }
@@ -0,0 +1,102 @@
+import os
+import re
+import shutil
+import torch
+from transformers import LlavaForConditionalGeneration
+
+
+class TorchBackend:
+    """Plain PyTorch in full precision on the CPU."""
+
+    name = "torch"
+    # Whether the model accepts inputs_embeds and past_key_values, which the prefix cache needs
+    supports_embeddings = True
+
+    def load(self, checkpoint):
+        """
+        Loads the model for a checkpoint.
+
+        Args:
+            checkpoint (str): The model checkpoint to load.
+
+        Returns:
+            The model, ready for forward and generate calls.
+        """
+        model = LlavaForConditionalGeneration.from_pretrained(checkpoint)
+        model.to("cpu")  # Use CPU instead of CUDA
+        model.eval()
+        return model
+
+
+class TorchInt8Backend(TorchBackend):
+    """PyTorch with the linear layers dynamically quantized to int8, about a quarter of the memory."""
+
+    name = "torch-int8"
+
+    def load(self, checkpoint):
+        model = super().load(checkpoint)
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class OpenVINOBackend:
+    """The model exported to OpenVINO IR with int8 weights, for Intel CPUs and NPUs."""
+
+    name = "openvino"
+    supports_embeddings = False
+
+    def __init__(self, device="CPU", cache_dir=None):
+        """
+        Args:
+            device (str): The OpenVINO device to run on.
+            cache_dir (str): Where exported models are kept, one directory per checkpoint.
+        """
+        self.device = device
+        self.cache_dir = cache_dir or os.environ.get(
+            "PRIMETIME_OV_CACHE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "openvino_models")
+        )
+
+    def export_path(self, checkpoint):
+        return os.path.join(self.cache_dir, re.sub(r"[^\w.-]+", "--", checkpoint) + "-int8")
+
+    def load(self, checkpoint):
+        # Optional dependency, only needed when this backend is selected
+        from optimum.intel import OVModelForVisualCausalLM, OVWeightQuantizationConfig
+
+        path = self.export_path(checkpoint)
+        if os.path.isdir(path):
+            return OVModelForVisualCausalLM.from_pretrained(path, device=self.device)
+
+        # Exporting and quantizing takes minutes and the full precision model's memory, so it is done once
+        print(f"Exporting {checkpoint} to OpenVINO, this only happens on the first run")
+        model = OVModelForVisualCausalLM.from_pretrained(
+            checkpoint,
+            export=True,
+            device=self.device,
+            quantization_config=OVWeightQuantizationConfig(bits=8),
+        )
+        # Saved next to the final directory and renamed, so an interrupted export is never loaded
+        temp_path = f"{path}.tmp"
+        shutil.rmtree(temp_path, ignore_errors=True)
+        model.save_pretrained(temp_path)
+        os.replace(temp_path, path)
+        return model
+
+
+BACKENDS = {
+    backend.name: backend for backend in (TorchBackend, TorchInt8Backend, OpenVINOBackend)
+}
+
+
+def get_backend(name):
+    """
+    Looks up an inference backend by name.
+
+    Args:
+        name (str): 'torch', 'torch-int8' or 'openvino'.
+
+    Returns:
+        An instance of the backend.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown inference backend '{name}', expected one of: {', '.join(BACKENDS)}")
+    return BACKENDS[name]()
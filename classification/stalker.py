@@ -1,102 +1,262 @@
-import time
+import os
 import json
+import argparse
 import traceback
-import ctypes
-import win32api
-import psutil
 import uuid
 import atexit
+import threading
 from datetime import datetime
-from activity_classifier import ActivityClassifier  # Import the classifier
+from classifier_loader import ClassifierLoader  # Loads the classifier in the background
+from classification_cache import ClassificationCache
+from frame_dedup import FrameDeduplicator
+from classification_worker import ClassificationWorker
+from cascade import CascadeClassifier, RuleTable, TextClassifier
+from event_encoding import EventEncoder
+from capture_backends import BACKENDS as CAPTURE_BACKENDS, RecordingBackend, get_backend
 from app_data_handler import (
     init_redis_client,
-    get_win,
     screenshot,
-    save_icon,
-    get_readable_exe_name,
+    save_screenshot,
+    get_app_metadata,
     process_app,
-    console_event_handler,
     cleanup,
-    clean_up_files,
     TIMESTAMP_FORMAT,
+    ICON_PATH,
+    EXE_CACHE_PATH,
+    CACHE_PATH,
+    RULES_PATH,
+    TEXT_MODEL_PATH,
 )
 
-import ctypes.wintypes
-
 # Initialize Redis client
 client = init_redis_client()
 
-# Initialize the ActivityClassifier
-classifier = ActivityClassifier()
+# Writes events to the activity stream, as JSON while PRIMETIME_EVENT_FORMAT=json for aggregators not updated yet
+events = EventEncoder(client, legacy=os.environ.get("PRIMETIME_EVENT_FORMAT") == "json") if client else None
 
-# Initialize global variables
-prev_uuid = None
+# Load the ActivityClassifier in the background so tracking starts immediately
+classifier_loader = ClassifierLoader(scoring=True)
 
-# Make the process DPI-aware
-ctypes.windll.user32.SetProcessDPIAware()
+# Cheap tiers in front of the vision model: user rules, then a text classifier over the names
+cascade = CascadeClassifier(RuleTable(RULES_PATH), TextClassifier(TEXT_MODEL_PATH))
 
+# Classifications of windows seen before, so revisiting them skips inference
+classification_cache = ClassificationCache(CACHE_PATH)
 
-# Define LASTINPUTINFO structure for tracking idle time
-class LASTINPUTINFO(ctypes.Structure):
-    _fields_ = [
-        ("cbSize", ctypes.wintypes.UINT),
-        ("dwTime", ctypes.wintypes.DWORD),
-    ]
+# Perceptual hashes of the last classified frame per window, so unchanged screens skip inference
+frame_dedup = FrameDeduplicator(max_distance=6)
 
+# Classification sent with an opened window until the worker has classified it, including while the model loads.
+# A window closed before that is reclassified afterwards, as Unclear if the model never got to it.
+PENDING_CLASSIFICATION = "Pending"
+FALLBACK_CLASSIFICATION = "Unclear"
 
-# Function to get the idle duration in seconds
-def get_idle_duration():
-    lastInputInfo = LASTINPUTINFO()
-    lastInputInfo.cbSize = ctypes.sizeof(LASTINPUTINFO)
-    if ctypes.windll.user32.GetLastInputInfo(ctypes.byref(lastInputInfo)):
-        millis = ctypes.windll.kernel32.GetTickCount() - lastInputInfo.dwTime
-        return millis / 1000.0  # Convert milliseconds to seconds
-    else:
-        return 0
+# Initialize global variables
+prev_uuid = None
+prev_classification = None
 
+# Held while emitting events, so a worker result never lands after its window was closed
+event_lock = threading.Lock()
 
-# Handles console events such as close, logoff, or shutdown.
-def handle_console_event(event):
-    global prev_uuid
-    return console_event_handler(event, prev_uuid, client)
+# Where windows, idle time and screenshots come from, set when monitoring starts
+capture = None
 
 
-# Register the console event handler so it can respond to system events.
-win32api.SetConsoleCtrlHandler(handle_console_event, True)
+# Sends the closing event for the window that had focus when the console is closed or the session ends.
+def handle_console_event():
+    on_exit()
 
 
 # Registers the cleanup function to ensure it is executed on exit.
 def on_exit():
     global prev_uuid
-    cleanup(prev_uuid, client)
+    cleanup(prev_uuid, events, capture.time() if capture else None)
 
 
 atexit.register(on_exit)
 
 
+# Classifies the activity in a window without the vision model: from the cheap tiers, or from earlier
+# results when the screen or the window is unchanged.
+# Returns the classification (None if the model is needed), the tier that answered, and the frame hash.
+def classify_cheap(hwnd, image, exe_name, app_name, win_title):
+    classification, tier = cascade.classify(exe_name, app_name, win_title)
+    if classification:
+        return classification, tier, None
+
+    frame_hash = None
+    if image is not None:
+        try:
+            frame_hash = frame_dedup.frame_hash(image)
+            classification = frame_dedup.match(hwnd, frame_hash)
+            if classification:
+                print(f"Frame unchanged, reusing classification: {frame_dedup.stats()}")
+                return classification, "dedup", frame_hash
+        except Exception as e:
+            print(f"Error hashing screenshot: {e}")
+
+    classification = classification_cache.get(app_name, win_title)
+    if classification:
+        print(f"Classification cache hit: {classification_cache.stats()}")
+        if frame_hash is not None:
+            frame_dedup.remember(hwnd, frame_hash, classification)
+        return classification, "cache", frame_hash
+    return None, None, frame_hash
+
+
+# Classifies a window, returning the classification, the tier that answered it and, if the vision model
+# is needed, the job to queue for the worker.
+def classify_window(event_id, hwnd, image, screenshot_path, exe_name, app_name, win_title, icon_path):
+    classification, tier, frame_hash = classify_cheap(
+        hwnd, image, exe_name, app_name, win_title
+    )
+    if classification:
+        cascade.record(tier)
+        return classification, tier, None
+
+    if image is None:
+        print("No screenshot available for classification.")
+        return "Unclear", None, None
+
+    job = {
+        "id": event_id,
+        "hwnd": hwnd,
+        "exe_name": exe_name,
+        "app_name": app_name,
+        "win_title": win_title,
+        "image": image,
+        "screenshot": screenshot_path,
+        "icon": icon_path,
+        "frame_hash": frame_hash,
+        # Queued before the model was ready, so it is still classified if its window is closed by then
+        "deferred": not classifier_loader.ready.is_set(),
+    }
+    if job["deferred"]:
+        print("Classifier still loading, classification pending.")
+    return PENDING_CLASSIFICATION, "vision", job
+
+
+# Runs the model for a queued job on the worker thread and records the result for later lookups.
+def classify_job(job):
+    classifier = classifier_loader.wait()
+    if classifier is None:
+        raise RuntimeError("The classifier failed to load")
+    # The window may have lost focus while the model was still loading.
+    if not is_needed(job):
+        return None
+
+    classification, scores = classifier.score_activity(
+        job["image"], job["app_name"], job["win_title"]
+    )
+    job["confidence"] = scores[classification]
+    cascade.record("vision")
+    print(f"Classification tiers: {cascade.stats()}")
+    # Leave unclear windows uncached so the model gets another look next time.
+    if classification != "Unclear":
+        classification_cache.put(job["app_name"], job["win_title"], classification)
+        cascade.text.learn(job["exe_name"], job["app_name"], job["win_title"], classification)
+        if job["frame_hash"] is not None:
+            frame_dedup.remember(job["hwnd"], job["frame_hash"], classification)
+    return classification
+
+
+# Whether the window a job was queued for still has focus.
+def is_current(job):
+    return job["id"] == prev_uuid
+
+
+# Whether the result of a job is still needed: its window has focus, or the window was opened as pending
+# while the model was loading and its closed session still has to be reclassified.
+def is_needed(job):
+    return is_current(job) or (job.get("pending") and job["deferred"])
+
+
+# Sends the worker's classification as an update event for the window if it is still open, or as a
+# reclassification of its closed session if the window was opened as pending.
+def finish_job(job, classification):
+    global prev_classification
+    if job.get("pending") and not classification:
+        # Dropped without a result, never leave the window pending
+        classification = FALLBACK_CLASSIFICATION
+    with event_lock:
+        if job.get("pending") and not is_current(job):
+            reclassify_event = {
+                "id": job["id"],
+                "timestamp": capture.time(),
+                "classification": classification,
+                "app_name": job["app_name"],
+                "win_title": job["win_title"],
+                "state": False,
+                "reclassify": True,
+                "screenshot": job["screenshot"],
+                "icon": job["icon"],
+                "tier": "vision" if job.get("confidence") is not None else None,
+                "confidence": job.get("confidence"),
+            }
+            print(json.dumps(reclassify_event, indent=4))
+
+            if events:
+                events.send(reclassify_event)
+        elif classification and is_current(job):
+            update_event = {
+                "id": job["id"],
+                "timestamp": capture.time(),
+                "classification": classification,
+                "app_name": job["app_name"],
+                "win_title": job["win_title"],
+                "state": True,
+                "screenshot": job["screenshot"],
+                "icon": job["icon"],
+                "deduplicated": False,
+                "tier": "vision",
+                "confidence": job.get("confidence"),
+            }
+            print(json.dumps(update_event, indent=4))
+
+            if events:
+                events.send(update_event)
+            prev_classification = classification
+
+
+# Background thread running the model, so the polling loop never waits on inference
+worker = ClassificationWorker(classify_job, is_needed, finish_job)
+
+
 # Continuously monitors the active window, logging any changes in foreground application.
-def check_foreground_win(delete=True):
+# The capture backend defaults to the Win32 desktop; a replay backend runs it from a trace anywhere.
+def check_foreground_win(delete=True, backend=None):
     prev_win_title = None  # Track the title of the previous active window.
     prev_hwnd = None  # Track the handle of the previous active window.
     prev_app_name = None  # Track the previous application's name.
     prev_icon_path = None  # Track the path to the previous icon.
+    prev_exe_name = None  # Track the previous executable's name.
     global prev_uuid
+    global prev_classification
     global last_state
+    global capture
     prev_uuid = None
     prev_classification = None
 
+    capture = backend or get_backend("win32", icon_dir=ICON_PATH, exe_cache_path=EXE_CACHE_PATH)
+    capture.on_close(handle_console_event)
+
+    if not classifier_loader.is_alive() and not classifier_loader.ready.is_set():
+        classifier_loader.start()
+    if not worker.is_alive():
+        worker.start()
+
     # Initialize timing variables
-    last_screenshot_time = time.time()
+    last_screenshot_time = capture.time()
     screenshot_interval = 180  # 3 minutes in seconds
     idle_threshold = 300  # 5 minutes in seconds
 
     try:
-        while True:
+        while capture.running():
             try:
-                current_time = time.time()
-                idle_duration = get_idle_duration()
+                current_time = capture.time()
+                idle_duration = capture.idle_duration()
 
-                hwnd, win_title = get_win()  # Get the current active window and title.
+                hwnd, win_title = capture.foreground_window()  # Get the current active window and title.
                 last_state = False
 
                 if (
@@ -104,78 +264,80 @@ def check_foreground_win(delete=True):
                 ):  # Detect a change in the active window.
                     timestamp = current_time
                     app_name, pid = process_app(
-                        hwnd
+                        capture, hwnd
                     )  # Get the app name and process ID of the current window.
                     if pid is None:
                         continue
-                    icon_path = save_icon(
-                        hwnd, pid
-                    )  # Save the application icon and get its path.
-                    app_name = (
-                        get_readable_exe_name(psutil.Process(pid).exe()) or app_name
-                    )  # Get the readable app name.
-
-                    # Log the "closed" event for the previous window if it exists.
-                    if prev_win_title:
-                        closed_event = {
-                            "id": prev_uuid,
-                            "timestamp": timestamp,
-                            "classification": prev_classification,
-                            "app_name": prev_app_name,
-                            "win_title": prev_win_title,
-                            "state": False,
-                            "screenshot": None,
-                            "icon": prev_icon_path,
-                        }
-                        if client:
-                            client.xadd("activity", {"data": json.dumps(closed_event)})
-                        print(json.dumps(closed_event, indent=4))
-
-                    # Capture a screenshot of the new active window
-                    screenshot_path = screenshot(hwnd)
+                    exe_name = app_name
+                    readable_name, icon_path = get_app_metadata(
+                        capture, pid
+                    )  # Get the readable app name and the path of its icon.
+                    app_name = readable_name or app_name
+
+                    # Capture a screenshot of the new active window, only keeping a copy on disk if files are kept
+                    image = screenshot(capture, hwnd)
+                    screenshot_path = save_screenshot(image) if image is not None and not delete else None
                     u = str(uuid.uuid4())
 
                     # Determine classification based on idle status
+                    tier = None
+                    job = None
                     if idle_duration >= idle_threshold:
                         classification = "Idle"
                     else:
-                        classification = "Unclear"
-                        if screenshot_path:
-                            try:
-                                classification = classifier.classify_activity(
-                                    screenshot_path, app_name, win_title
-                                )
-                            except Exception as e:
-                                print(f"Error classifying activity: {e}")
-                                traceback.print_exc()
-                        else:
-                            print("No screenshot available for classification.")
-
-                    opened_event = {
-                        "id": u,
-                        "timestamp": timestamp,
-                        "classification": classification,
-                        "app_name": app_name,
-                        "win_title": win_title,
-                        "state": True,
-                        "screenshot": screenshot_path,
-                        "icon": icon_path,
-                    }
-                    print(json.dumps(opened_event, indent=4))
-
-                    if client:
-                        client.xadd("activity", {"data": json.dumps(opened_event)})
-
-                    # Clean up files
-                    clean_up_files(icon_path, screenshot_path, delete)
+                        # A job means the window opens as pending and the worker follows up with an update event.
+                        classification, tier, job = classify_window(
+                            u, hwnd, image, screenshot_path, exe_name, app_name, win_title, icon_path
+                        )
+
+                    with event_lock:
+                        # Log the "closed" event for the previous window if it exists.
+                        if prev_win_title:
+                            closed_event = {
+                                "id": prev_uuid,
+                                "timestamp": timestamp,
+                                "classification": prev_classification,
+                                "app_name": prev_app_name,
+                                "win_title": prev_win_title,
+                                "state": False,
+                                "screenshot": None,
+                                "icon": prev_icon_path,
+                            }
+                            if events:
+                                events.send(closed_event)
+                            print(json.dumps(closed_event, indent=4))
+
+                        opened_event = {
+                            "id": u,
+                            "timestamp": timestamp,
+                            "classification": classification,
+                            "app_name": app_name,
+                            "win_title": win_title,
+                            "state": True,
+                            "screenshot": screenshot_path,
+                            "icon": icon_path,
+                            "deduplicated": tier == "dedup",
+                            "tier": tier,
+                        }
+                        print(json.dumps(opened_event, indent=4))
+
+                        if events:
+                            events.send(opened_event)
+
+                        prev_uuid = u
+                        prev_classification = classification
+
+                    if job:
+                        # The window was opened as pending, it is reclassified even once closed
+                        job["pending"] = True
+                        worker.submit(job)
 
                     # Update previous variables
                     prev_win_title = win_title
                     prev_hwnd = hwnd
                     prev_app_name = app_name
+                    prev_exe_name = exe_name
                     prev_icon_path = icon_path
-                    prev_uuid = u
-                    prev_classification = classification
 
                     # Reset last_screenshot_time
                     last_screenshot_time = current_time
@@ -188,48 +350,54 @@ def check_foreground_win(delete=True):
                     if current_time - last_screenshot_time >= screenshot_interval:
                         # Time to take a new screenshot
                         timestamp = current_time
-                        screenshot_path = screenshot(hwnd)
+                        image = screenshot(capture, hwnd)
+                        screenshot_path = save_screenshot(image) if image is not None and not delete else None
 
                         # Determine classification based on idle status
+                        tier = None
+                        job = None
                         if idle_duration >= idle_threshold:
                             classification = "Idle"
                         else:
-                            classification = "Unclear"
-                            if screenshot_path:
-                                try:
-                                    classification = classifier.classify_activity(
-                                        screenshot_path, prev_app_name, prev_win_title
-                                    )
-                                except Exception as e:
-                                    print(f"Error classifying activity: {e}")
-                                    traceback.print_exc()
-                            else:
-                                print("No screenshot available for classification.")
-
-                        # Create update event with the same UUID
-                        update_event = {
-                            "id": prev_uuid,
-                            "timestamp": timestamp,
-                            "classification": classification,
-                            "app_name": prev_app_name,
-                            "win_title": prev_win_title,
-                            "state": True,
-                            "screenshot": screenshot_path,
-                            "icon": prev_icon_path,
-                        }
-                        print(json.dumps(update_event, indent=4))
-
-                        if client:
-                            client.xadd("activity", {"data": json.dumps(update_event)})
-
-                        # Clean up files
-                        clean_up_files(None, screenshot_path, delete)
-
-                        # Update last_screenshot_time and classification
+                            classification, tier, job = classify_window(
+                                prev_uuid,
+                                hwnd,
+                                image,
+                                screenshot_path,
+                                prev_exe_name,
+                                prev_app_name,
+                                prev_win_title,
+                                prev_icon_path,
+                            )
+
+                        if job:
+                            # The worker sends the update event once the model is done.
+                            worker.submit(job)
+                        else:
+                            # Create update event with the same UUID
+                            update_event = {
+                                "id": prev_uuid,
+                                "timestamp": timestamp,
+                                "classification": classification,
+                                "app_name": prev_app_name,
+                                "win_title": prev_win_title,
+                                "state": True,
+                                "screenshot": screenshot_path,
+                                "icon": prev_icon_path,
+                                "deduplicated": tier == "dedup",
+                                "tier": tier,
+                            }
+                            print(json.dumps(update_event, indent=4))
+
+                            with event_lock:
+                                if events:
+                                    events.send(update_event)
+                                prev_classification = classification
+
+                        # Update last_screenshot_time
                         last_screenshot_time = current_time
-                        prev_classification = classification
 
-                time.sleep(0.5)
+                capture.sleep(0.5)
 
             except Exception as e:
                 print(f"Error in main loop: {e}")
@@ -241,8 +409,30 @@ def check_foreground_win(delete=True):
 
 
 # Main entry point of the script, starts the monitoring function.
+#
+#   python stalker.py                                          # the Win32 desktop
+#   python stalker.py --capture replay --switches 100000 --delete  # a generated trace, as fast as possible
+#   python stalker.py --record trace.jsonl                     # the Win32 desktop, recording a trace to replay
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Track the foreground window and send its activity to Redis.")
+    parser.add_argument("--capture", default=os.environ.get("PRIMETIME_CAPTURE", "win32"), choices=list(CAPTURE_BACKENDS))
+    parser.add_argument("--trace", help="Trace file to replay, generated if not given")
+    parser.add_argument("--switches", type=int, default=1000, help="Window switches of a generated trace")
+    parser.add_argument("--speed", type=float, default=0, help="Replay speed over real time, 0 for as fast as possible")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of a generated trace")
+    parser.add_argument("--record", help="Append the window switches seen to this trace file")
+    parser.add_argument("--delete", action="store_true", help="Don't keep screenshots on disk")
+    args = parser.parse_args()
+
     try:
-        check_foreground_win(delete=False)
+        if args.capture == "replay":
+            backend = get_backend(
+                "replay", trace=args.trace, speed=args.speed, switches=args.switches, seed=args.seed
+            )
+        else:
+            backend = get_backend(args.capture, icon_dir=ICON_PATH, exe_cache_path=EXE_CACHE_PATH)
+        if args.record:
+            backend = RecordingBackend(backend, args.record)
+        check_foreground_win(delete=args.delete, backend=backend)
     except Exception as e:
         print(f"Unhandled exception in main: {e}")
@@ -3,6 +3,7 @@ import transformers
 print(transformers.__version__)
 
 import requests
+import torch
 from PIL import Image
 from transformers import (
     LlavaForConditionalGeneration,
@@ -19,7 +20,8 @@ processor = LlavaGemmaProcessor(
     image_processor=CLIPImageProcessor.from_pretrained(checkpoint),
 )
 
-model.to("cuda")
+device = "cuda" if torch.cuda.is_available() else "cpu"
+model.to(device)
 
 prompt = processor.tokenizer.apply_chat_template(
     [{"role": "user", "content": "Based on the following content, identify if the user is likely engaged in work or entertainment. Consider text in documents, open applications, visual elements, and any activity keywords. Work activities often include tasks like coding, document editing, or productivity apps, while entertainment activities might involve gaming, streaming, or social media. Respond with 'Work,' 'Entertainment,' or 'Unclear' based on the provided input.<image>"}],
@@ -29,7 +31,7 @@ prompt = processor.tokenizer.apply_chat_template(
 url = "https://www.ilankelman.org/stopsigns/australia.jpg"
 image = Image.open(requests.get(url, stream=True).raw)
 inputs = processor(text=prompt, images=image, return_tensors="pt")
-inputs = {k: v.to("cuda") for k, v in inputs.items()}
+inputs = {k: v.to(device) for k, v in inputs.items()}
 
 # Generate
 generate_ids = model.generate(**inputs, max_length=30)